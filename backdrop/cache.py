@@ -0,0 +1,168 @@
+"""
+This module caches encoded query responses
+
+Entries are keyed by data set id and a normalised form of the parsed query
+so equivalent requests share an entry however their args were ordered.
+Entries are evicted least recently used first once the cache is over its
+memory budget, and expire after a time to live. Each invalidation of a data
+set starts a new generation of it, a response built from a query that
+started in an earlier generation is not cached.
+
+Example:
+    cache = QueryCache()
+
+    body = cache.get(data_set_id, key)
+    if body is None:
+        generation = cache.generation(data_set_id)
+        body = build_response()
+        cache.set(data_set_id, key, body, generation=generation)
+
+    # drop everything cached for a data set when it is written to
+    cache.invalidate(data_set_id)
+"""
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from .timeutils import Period
+
+
+__all__ = ['QueryCache', 'normalise_query']
+
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TTL = 300
+
+
+class QueryCache(object):
+    """An LRU cache of response bodies with a TTL and a memory budget
+
+    >>> cache = QueryCache(max_bytes=10)
+    >>> cache.set("foo", "a", "12345")
+    >>> cache.get("foo", "a")
+    '12345'
+    >>> cache.set("foo", "b", "123456")
+    >>> cache.get("foo", "a") is None
+    True
+    >>> cache.invalidate("foo")
+    >>> cache.get("foo", "b") is None
+    True
+    >>> sorted(cache.stats().items())
+    [('bytes', 0), ('entries', 0), ('evictions', 1), ('hits', 1), ('misses', 2)]
+
+    >>> cache.set("foo", "a", "123", ttl=0)
+    >>> cache.get("foo", "a") is None
+    True
+
+    >>> generation = cache.generation("foo")
+    >>> cache.invalidate("foo")
+    >>> cache.set("foo", "a", "123", generation=generation)
+    >>> cache.get("foo", "a") is None
+    True
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL,
+                 clock=time.time):
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._generations = defaultdict(int)
+        self._reset()
+
+    def get(self, data_set_id, key):
+        with self._lock:
+            entry = self._entries.pop((data_set_id, key), None)
+            if entry is None or entry[0] <= self._clock():
+                if entry is not None:
+                    self._forget(data_set_id, key, entry)
+                self._misses += 1
+                return None
+            self._entries[(data_set_id, key)] = entry
+            self._hits += 1
+            return entry[1]
+
+    def generation(self, data_set_id):
+        """The data set's current generation, to pass to set"""
+        with self._lock:
+            return self._generations[data_set_id]
+
+    def set(self, data_set_id, key, body, ttl=None, generation=None):
+        """Cache a body unless the data set has been invalidated since the
+        given generation
+
+        A TTL of 0 means the body is not cached.
+        """
+        if ttl is None:
+            ttl = self._ttl
+        if ttl <= 0 or len(body) > self._max_bytes:
+            return
+        expires_at = self._clock() + ttl
+        with self._lock:
+            if generation is not None and \
+                    generation != self._generations[data_set_id]:
+                return
+            previous = self._entries.pop((data_set_id, key), None)
+            if previous is not None:
+                self._forget(data_set_id, key, previous)
+            self._entries[(data_set_id, key)] = (expires_at, body)
+            self._keys_by_data_set[data_set_id].add(key)
+            self._bytes += len(body)
+            while self._bytes > self._max_bytes:
+                (evicted_id, evicted_key), entry = \
+                    self._entries.popitem(last=False)
+                self._forget(evicted_id, evicted_key, entry)
+                self._evictions += 1
+
+    def invalidate(self, data_set_id):
+        with self._lock:
+            self._generations[data_set_id] += 1
+            for key in self._keys_by_data_set.pop(data_set_id, set()):
+                entry = self._entries.pop((data_set_id, key))
+                self._bytes -= len(entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        self._entries = OrderedDict()
+        self._keys_by_data_set = defaultdict(set)
+        self._bytes = 0
+        self._hits = self._misses = self._evictions = 0
+
+    def stats(self):
+        return {
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+    def _forget(self, data_set_id, key, entry):
+        """Remove bookkeeping for an entry already popped from the cache"""
+        self._bytes -= len(entry[1])
+        keys = self._keys_by_data_set.get(data_set_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_data_set[data_set_id]
+
+
+def normalise_query(query):
+    """Return a hashable form of a parsed query
+
+    >>> normalise_query({"limit": 1, "filter_by": {"b": 1, "a": 2}})
+    (('filter_by', (('a', 2), ('b', 1))), ('limit', 1))
+    >>> from backdrop.timeutils import WEEK
+    >>> normalise_query({"period": WEEK, "collect": [["foo", "sum"]]})
+    (('collect', (('foo', 'sum'),)), ('period', 'week'))
+    """
+    if isinstance(query, dict):
+        return tuple(sorted((key, normalise_query(value))
+                            for key, value in query.items()))
+    if isinstance(query, (list, tuple)):
+        return tuple(normalise_query(value) for value in query)
+    if isinstance(query, Period):
+        return query.name
+    return query
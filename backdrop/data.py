@@ -1,28 +1,46 @@
 """
 This module handles validtion and processing of incoming records
 """
-from functools import partial
+import cPickle
+import json
+import multiprocessing
+import tempfile
+import threading
+from collections import deque
+from contextlib import closing
+from itertools import chain, islice
 
-from dateutil.parser import parse as parse_datetime
-from jsonschema import validate, FormatChecker
+from jsonschema import FormatChecker, ValidationError
+from jsonschema.validators import validator_for
 
-from .timeutils import PERIODS
+from .models import thaw
+from .storage.base import batches
+from .timeutils import parse_datetime, period_starts
 
 
-__all__ = ['create_record_parser']
+__all__ = ['create_record_parser', 'RecordParsers', 'RecordPool',
+           'InvalidRecord', 'read_ndjson', 'spool_records']
 
 
-def create_record_parser(schema):
+def create_record_parser(schema, datetime_fields=None):
     """Return a function that parses incoming records and adds meta fields
 
     - Validate records against the JSONSchema
     - Parse datetime fields based on the JSONSchema
     - Add meta fields for period start tiestamps
+
+    The schema is checked and compiled into a validator once, up front, so
+    the returned function only does per record work. The date-time fields
+    are found from the schema unless they are already known.
     """
+    validator = compile_validator(schema)
+    if datetime_fields is None:
+        datetime_fields = get_datetime_fields(schema)
+
     def record_parser(record):
-        validate_record(record, schema)
-        
-        record = parse_values(record, schema)
+        validator.validate(record)
+
+        record = parse_datetime_fields(record, datetime_fields)
         record = add_meta_fields(record)
 
         return record
@@ -30,46 +48,302 @@ def create_record_parser(schema):
     return record_parser
 
 
-def validate_record(record, schema):
-    validate(record, schema=schema, format_checker=FormatChecker())
+class RecordParsers(object):
+    """Record parsers cached by data set id and schema version
 
+    A parser is rebuilt when the version for a data set changes, ie. when
+    its schema file has been modified.
 
-def parse_values(record, schema):
-    """Parse values that cannot be represented in JSON
-    >>> fields = {"field": {"type": "string", "format": "date-time"}}
-    >>> schema = {"properties": fields}
-    >>> record = {"field": "2012-12-12T00:00:00+00:00"}
-    >>> parse_values(record, schema)
-    {'field': datetime.datetime(2012, 12, 12, 0, 0, tzinfo=tzutc())}
+    >>> parsers = RecordParsers()
+    >>> parser = parsers.get("foo", 1, {"properties": {}})
+    >>> parser is parsers.get("foo", 1, {"properties": {}})
+    True
+    >>> parser is parsers.get("foo", 2, {"properties": {}})
+    False
     """
-    for field_name, field in schema['properties'].items():
-        if field.get('format') == "date-time":
-            if field_name in record:
-                record[field_name] = parse_datetime(record[field_name])
+    def __init__(self):
+        self._parsers = {}
+        self._lock = threading.Lock()
 
-    return record
+    def get(self, data_set_id, version, schema, datetime_fields=None):
+        cached = self._parsers.get(data_set_id)
+        if cached is None or cached[0] != version:
+            with self._lock:
+                cached = self._parsers.get(data_set_id)
+                if cached is None or cached[0] != version:
+                    cached = (version,
+                              create_record_parser(schema, datetime_fields))
+                    self._parsers[data_set_id] = cached
+        return cached[1]
 
 
-def add_meta_fields(record):
+class InvalidRecord(StandardError):
+    """A record that could not be parsed, with its position in the upload"""
+    def __init__(self, index, message):
+        super(InvalidRecord, self).__init__(
+            "Record {} is invalid: {}".format(index, message))
+        self.index = index
+        self.message = message
+
+
+class RecordPool(object):
+    """Parse large uploads on a pool of processes
+
+    Uploads of fewer than threshold records, or any upload if processes is
+    0, are parsed in process as they are read. Larger ones are split into
+    chunks which worker processes validate and parse with their own cached
+    parsers. Records come back in order, and the first invalid record
+    raises InvalidRecord with its position, as it would in process.
+
+    The upload is read and split into chunks in the calling thread, a few
+    chunks ahead of the records returned.
+
+    >>> pool = RecordPool(RecordParsers())
+    >>> list(pool.parse("foo", 1, {"properties": {}}, [], [{"a": 1}]))
+    [{'a': 1}]
+
+    >>> pool = RecordPool(RecordParsers(), processes=2, threshold=10,
+    ...                   chunk_size=5)
+    >>> lines = ['{"a": 1}'] * 30
+    >>> len(list(pool.parse("foo", 1, {"properties": {}}, [],
+    ...                     read_ndjson(lines))))
+    30
+    >>> lines[22] = '{"a": '
+    >>> list(pool.parse("foo", 1, {"properties": {}}, [], read_ndjson(lines)))
+    Traceback (most recent call last):
+        ...
+    InvalidRecord: Record 22 is invalid: No JSON object could be decoded
+    >>> pool.close()
     """
-    >>> from datetime import datetime
-    >>> add_meta_fields({'_timestamp': datetime(2012, 12, 12)}).keys()
-    ['_timestamp', '_hour_start_at', '_day_start_at', '_month_start_at', '_week_start_at', '_quarter_start_at']
+    THRESHOLD = 5000
+    CHUNK_SIZE = 1000
+
+    def __init__(self, parsers, processes=0, threshold=None, chunk_size=None):
+        self.processes = processes
+        self._parsers = parsers
+        self._threshold = threshold or self.THRESHOLD
+        self._chunk_size = chunk_size or self.CHUNK_SIZE
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def parse(self, data_set_id, version, schema, datetime_fields, records):
+        """Return an iterator over the parsed records"""
+        records = iter(records)
+        first = list(islice(records, self._threshold))
+        if not self.processes or len(first) < self._threshold:
+            parser = self._parsers.get(
+                data_set_id, version, schema, datetime_fields)
+            return parse_records(parser, chain(first, records))
+
+        # Frozen metadata cannot be unpickled in the workers
+        schema = thaw(schema)
+        tasks = ((data_set_id, version, schema, datetime_fields,
+                  offset, chunk)
+                 for offset, chunk in batches(chain(first, records),
+                                              self._chunk_size))
+        return join_chunks(parse_in_pool(self._get_pool(), tasks,
+                                         2 * self.processes))
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.processes)
+            return self._pool
+
+
+def parse_records(parser, records):
+    """Parse records one at a time, raising InvalidRecord at the first error
+
+    >>> list(parse_records(int, ["1", "2"]))
+    [1, 2]
+    >>> list(parse_records(int, ["1", "a"]))
+    Traceback (most recent call last):
+        ...
+    InvalidRecord: Record 1 is invalid: invalid literal for int() with base 10: 'a'
     """
-    if "_timestamp" in record:
-        for period in PERIODS:
-            period_start = period.start(record['_timestamp'])
+    for index, record in enumerate(records):
+        try:
+            yield parser(record)
+        except (ValidationError, ValueError) as e:
+            raise InvalidRecord(index, error_message(e))
+
+
+def parse_chunk(parser, offset, records):
+    """Parse a chunk of records, stopping at the first error
+
+    Returns the records parsed and the position and message of the error,
+    if there was one.
+
+    >>> parse_chunk(int, 10, ["1", "a", "3"])
+    ([1], (11, "invalid literal for int() with base 10: 'a'"))
+    """
+    parsed = []
+    for index, record in enumerate(records, offset):
+        try:
+            parsed.append(parser(record))
+        except (ValidationError, ValueError) as e:
+            return parsed, (index, error_message(e))
+    return parsed, None
+
+
+# Parsers cached in each worker process of a RecordPool
+worker_parsers = RecordParsers()
+
+
+def parse_chunk_task(task):
+    data_set_id, version, schema, datetime_fields, offset, records = task
+    parser = worker_parsers.get(data_set_id, version, schema, datetime_fields)
+    return parse_chunk(parser, offset, records)
+
+
+def parse_in_pool(pool, tasks, window):
+    """Parse chunk tasks on a pool, yielding results in order
+
+    Tasks are read in this thread, at most window ahead of the results. An
+    InvalidRecord raised reading them comes after the results of the tasks
+    before it.
+    """
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append(pool.apply_async(parse_chunk_task, (task,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+    except InvalidRecord as error:
+        while pending:
+            yield pending.popleft().get()
+        raise error
+    while pending:
+        yield pending.popleft().get()
+
+
+def join_chunks(results):
+    """Yield parsed records from chunks in order, raising at the first error
+
+    >>> list(join_chunks([([1, 2], None), ([3], (3, "bad")), ([5], None)]))
+    Traceback (most recent call last):
+        ...
+    InvalidRecord: Record 3 is invalid: bad
+    """
+    for parsed, error in results:
+        for record in parsed:
+            yield record
+        if error is not None:
+            raise InvalidRecord(*error)
+
+
+def error_message(error):
+    if isinstance(error, ValidationError):
+        return error.message
+    return str(error)
+
+
+def read_ndjson(lines):
+    """Parse newline delimited JSON records lazily, one line at a time
+
+    A line that is not JSON raises InvalidRecord with its record's position.
+
+    >>> list(read_ndjson(['{"foo": 1}\\n', '\\n', '{"foo": 2}']))
+    [{u'foo': 1}, {u'foo': 2}]
+    >>> list(read_ndjson(['{"foo": 1}\\n', 'foo\\n']))
+    Traceback (most recent call last):
+        ...
+    InvalidRecord: Record 1 is invalid: No JSON object could be decoded
+    """
+    index = 0
+    for line in lines:
+        if line.strip():
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise InvalidRecord(index, str(e))
+            yield record
+            index += 1
+
+
+# Spooled records are kept in memory up to this many bytes
+SPOOL_SIZE = 16 * 1024 * 1024
+
+
+def spool_records(records, max_size=SPOOL_SIZE):
+    """Read every record into a temporary file and return an iterator over them
+
+    Any error parsing the records is raised before one is returned, so an
+    upload can be rejected before any of it is saved. Records past
+    max_size bytes are written to disk rather than held in memory.
+
+    >>> records = spool_records(iter([{"a": 1}, {"a": 2}]))
+    >>> list(records)
+    [{'a': 1}, {'a': 2}]
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size)
+    try:
+        for record in records:
+            cPickle.dump(record, spool, cPickle.HIGHEST_PROTOCOL)
+    except:
+        spool.close()
+        raise
+    spool.seek(0)
+    return unspool(spool)
+
+
+def unspool(spool):
+    with closing(spool):
+        while True:
+            try:
+                yield cPickle.load(spool)
+            except EOFError:
+                return
+
+
+def compile_validator(schema):
+    """Check a schema and return a validator instance for it
+
+    >>> validator = compile_validator({"type": "object"})
+    >>> validator.is_valid({})
+    True
+    >>> validator.is_valid([])
+    False
+    """
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema, format_checker=FormatChecker())
+
+
+def get_datetime_fields(schema):
+    """Return the names of fields with a date-time format
+
+    >>> get_datetime_fields({"properties": {
+    ...     "foo": {"type": "string", "format": "date-time"},
+    ...     "bar": {"type": "string"}}})
+    ['foo']
+    """
+    return [field_name
+            for field_name, field in schema.get('properties', {}).items()
+            if field.get('format') == "date-time"]
+
+
+def parse_datetime_fields(record, datetime_fields):
+    for field_name in datetime_fields:
+        if field_name in record:
+            record[field_name] = parse_datetime(record[field_name])
 
-            record = add_fields(record, **{
-                period.start_at_key:period_start})
     return record
 
 
-def add_fields(record, **kwargs):
+def add_meta_fields(record):
     """
-    >>> add_fields({}, foo="bar")
-    {'foo': 'bar'}
-    >>> add_fields({"foo":"foo"}, foo="bar")
-    {'foo': 'bar'}
+    >>> from datetime import datetime
+    >>> sorted(add_meta_fields({'_timestamp': datetime(2012, 12, 12)}).keys())
+    ['_day_start_at', '_hour_start_at', '_month_start_at', '_quarter_start_at', '_timestamp', '_week_start_at']
     """
-    return dict(record.items() + kwargs.items())
+    if "_timestamp" in record:
+        record.update(period_starts(record['_timestamp']))
+    return record
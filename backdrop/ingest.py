@@ -0,0 +1,286 @@
+"""
+This module writes records to storage in the background
+
+Records are put on a bounded in-process queue and a pool of writer threads
+takes them off, coalescing records queued by different requests into one
+save per data set. Each submission gets a receipt that is updated once its
+records have been written.
+
+Example:
+    queue = IngestQueue(storage.save)
+
+    # raises QueueFull if there is no room within the timeout
+    receipt = queue.submit(data_set_id, data_set, records, timeout=1)
+
+    # look a receipt up later
+    queue.receipt(receipt.id).as_dict()
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque, namedtuple
+from itertools import chain
+
+
+__all__ = ['IngestQueue', 'QueueFull']
+
+
+log = logging.getLogger(__name__)
+
+
+class QueueFull(StandardError):
+    pass
+
+
+class Receipt(object):
+    """The state of records submitted to an ingest queue"""
+    def __init__(self, data_set_id, count):
+        self.id = uuid.uuid4().hex
+        self.data_set_id = data_set_id
+        self.count = count
+        self.status = "queued"
+        self.saved = 0
+        self.failed = []
+        self.error = None
+
+    def written(self, saved, failed):
+        self.saved, self.failed = saved, failed
+        self.status = "error" if failed else "saved"
+
+    def errored(self, error):
+        self.error = error
+        self.failed = range(self.count)
+        self.status = "error"
+
+    def as_dict(self):
+        receipt = {
+            "receipt": self.id,
+            "data_set": self.data_set_id,
+            "status": self.status,
+            "records": self.count,
+            "saved": self.saved,
+        }
+        if self.failed:
+            receipt["failed"] = self.failed
+        if self.error:
+            receipt["error"] = self.error
+        return receipt
+
+
+QueuedRecords = namedtuple("QueuedRecords",
+                           ["receipt", "data_set_id", "data_set", "records"])
+
+
+class IngestQueue(object):
+    """A bounded queue of records written to storage by writer threads
+
+    save is called as save(data_set_id, records, data_set) and returns the
+    number saved and the indexes of any that failed, as Data.save does.
+    on_written, if given, is called with the data set id and metadata after
+    each write. Errors from either are logged, and a failed save is put on
+    the receipts of its records.
+
+    >>> saves = []
+    >>> queue = IngestQueue(lambda *args: saves.append(args) or (2, []),
+    ...                     max_wait=0)
+    >>> receipt = queue.submit("foo", {}, [{"a": 1}, {"a": 2}])
+    >>> queue.join()
+    >>> receipt.status, receipt.saved, len(saves)
+    ('saved', 2, 1)
+    >>> queue.close()
+
+    >>> def fail(*args):
+    ...     raise ValueError("down")
+    >>> queue = IngestQueue(fail, on_written=fail, max_wait=0)
+    >>> receipt = queue.submit("foo", {}, [{"a": 1}])
+    >>> queue.join()
+    >>> receipt.status, receipt.error
+    ('error', 'down')
+    >>> queue.close()
+    """
+    MAX_RECORDS = 100000
+    WORKERS = 2
+    BATCH_SIZE = 1000
+    MAX_WAIT = 0.1
+    MAX_RECEIPTS = 10000
+
+    def __init__(self, save, on_written=None, max_records=None, workers=None,
+                 batch_size=None, max_wait=None, max_receipts=None):
+        self._save = save
+        self._on_written = on_written
+        self._max_records = max_records or self.MAX_RECORDS
+        self._workers = workers or self.WORKERS
+        self._batch_size = batch_size or self.BATCH_SIZE
+        self._max_wait = max_wait if max_wait is not None else self.MAX_WAIT
+        self._max_receipts = max_receipts or self.MAX_RECEIPTS
+
+        self._condition = threading.Condition()
+        self._queued = deque()
+        self._queued_records = 0
+        self._unwritten_records = 0
+        self._receipts = OrderedDict()
+        self._threads = []
+        self._closed = False
+
+    def submit(self, data_set_id, data_set, records, timeout=0):
+        """Queue records to be written, waiting up to timeout for room
+
+        A submission larger than the whole queue is let in once the queue
+        is empty.
+        """
+        records = list(records)
+        deadline = time.time() + timeout
+        with self._condition:
+            if self._closed:
+                raise QueueFull("ingest queue is closed")
+            self._start_workers()
+            while self._unwritten_records and \
+                    self._unwritten_records + len(records) > self._max_records:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise QueueFull("ingest queue is full")
+                self._condition.wait(remaining)
+
+            receipt = Receipt(data_set_id, len(records))
+            self._queued.append(
+                QueuedRecords(receipt, data_set_id, data_set, records))
+            self._queued_records += len(records)
+            self._unwritten_records += len(records)
+            self._remember(receipt)
+            self._condition.notify_all()
+
+        return receipt
+
+    def receipt(self, receipt_id):
+        with self._condition:
+            return self._receipts.get(receipt_id)
+
+    def join(self, timeout=None):
+        """Wait until every queued record has been written"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._unwritten_records:
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return
+                    self._condition.wait(remaining)
+
+    def close(self):
+        """Write what is queued then stop the writer threads"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        with self._condition:
+            return {
+                "queued": self._queued_records,
+                "unwritten": self._unwritten_records,
+                "max_records": self._max_records,
+            }
+
+    def _start_workers(self):
+        if not self._threads:
+            for _ in range(self._workers):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _remember(self, receipt):
+        self._receipts[receipt.id] = receipt
+        while len(self._receipts) > self._max_receipts:
+            self._receipts.popitem(last=False)
+
+    def _work(self):
+        while True:
+            taken = self._take()
+            if taken is None:
+                return
+            self._write(taken)
+
+    def _take(self):
+        """Take queued records once there is a batch of them
+
+        Waits up to max_wait for other requests to fill a batch. Returns None
+        once the queue is closed and empty.
+        """
+        with self._condition:
+            while not self._queued and not self._closed:
+                self._condition.wait()
+            if not self._queued:
+                return None
+
+            deadline = time.time() + self._max_wait
+            while self._queued_records < self._batch_size \
+                    and not self._closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            taken, count = [], 0
+            while self._queued and (not taken or
+                    count + len(self._queued[0].records) <= self._batch_size):
+                queued = self._queued.popleft()
+                taken.append(queued)
+                count += len(queued.records)
+            self._queued_records -= count
+            return taken
+
+    def _write(self, taken):
+        by_data_set = OrderedDict()
+        for queued in taken:
+            by_data_set.setdefault(queued.data_set_id, []).append(queued)
+
+        for data_set_id, queued in by_data_set.items():
+            try:
+                self._write_data_set(data_set_id, queued)
+            finally:
+                with self._condition:
+                    self._unwritten_records -= sum(
+                        len(q.records) for q in queued)
+                    self._condition.notify_all()
+
+    def _write_data_set(self, data_set_id, queued):
+        # The latest metadata is used for the whole write
+        data_set = queued[-1].data_set
+        records = list(chain.from_iterable(q.records for q in queued))
+        try:
+            saved, failed = self._save(data_set_id, records, data_set)
+        except Exception as e:
+            log.exception("Could not write %d records to %s",
+                          len(records), data_set_id)
+            for q in queued:
+                q.receipt.errored(str(e))
+        else:
+            assign_failures(queued, failed)
+
+        if self._on_written is not None:
+            try:
+                self._on_written(data_set_id, data_set)
+            except Exception:
+                log.exception("on_written failed for %s", data_set_id)
+
+def assign_failures(queued, failed):
+    """Split failed record indexes from a combined write between receipts
+
+    >>> queued = [QueuedRecords(Receipt("foo", 2), "foo", {}, [1, 2]),
+    ...           QueuedRecords(Receipt("foo", 2), "foo", {}, [3, 4])]
+    >>> assign_failures(queued, [3])
+    >>> [(q.receipt.saved, q.receipt.failed) for q in queued]
+    [(2, []), (1, [1])]
+    """
+    offset = 0
+    for q in queued:
+        count = len(q.records)
+        own = [index - offset for index in failed
+               if offset <= index < offset + count]
+        q.receipt.written(count - len(own), own)
+        offset += count
@@ -0,0 +1,283 @@
+"""
+This module times requests and exposes the timings to Prometheus
+
+Each request gets a timer that adds up the time spent in each stage, eg.
+loading metadata, parsing records, querying storage, building results and
+encoding. Stages may be nested, time in an inner stage is not counted in
+the outer one. When the request is finished the stage totals are observed
+in per data set histograms.
+
+A small fraction of requests can also be run under cProfile, keeping the
+profile of those that turn out to be slow.
+
+Example:
+    metrics = Metrics()
+
+    timer = metrics.timer("foo", "query_data_set")
+    with timer.stage("query"):
+        results = list(storage.query(...))
+    # or time the iteration of a lazy iterable
+    results = timer.wrap("query", storage.query(...))
+    timer.finish(200)
+
+    # the Prometheus text format
+    metrics.render()
+"""
+import cProfile
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+__all__ = ['Metrics', 'SampledProfiler']
+
+
+# Histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+METRICS = {
+    "backdrop_stage_seconds": (
+        "histogram", "Time spent in each stage of a request"),
+    "backdrop_request_seconds": (
+        "histogram", "Time from the start of a request to its last byte"),
+    "backdrop_requests_total": (
+        "counter", "Requests by response status"),
+    "backdrop_records_total": (
+        "counter", "Records written by outcome"),
+}
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """Histograms and counters keyed by name and labels
+
+    >>> metrics = Metrics(buckets=(0.1, 1))
+    >>> metrics.observe("backdrop_stage_seconds",
+    ...                 {"data_set": "foo", "stage": "query"}, 0.5)
+    >>> print metrics.render()
+    # HELP backdrop_stage_seconds Time spent in each stage of a request
+    # TYPE backdrop_stage_seconds histogram
+    backdrop_stage_seconds_bucket{data_set="foo",stage="query",le="0.1"} 0
+    backdrop_stage_seconds_bucket{data_set="foo",stage="query",le="1"} 1
+    backdrop_stage_seconds_bucket{data_set="foo",stage="query",le="+Inf"} 1
+    backdrop_stage_seconds_sum{data_set="foo",stage="query"} 0.5
+    backdrop_stage_seconds_count{data_set="foo",stage="query"} 1
+    <BLANKLINE>
+    """
+    def __init__(self, buckets=None):
+        self._buckets = tuple(buckets or BUCKETS)
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def timer(self, data_set_id, endpoint):
+        return RequestTimer(self, data_set_id or "", endpoint or "")
+
+    def observe(self, name, labels, value):
+        key = (name, label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self._buckets)
+            histogram.observe(value)
+
+    def increment(self, name, labels, value=1):
+        key = (name, label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format"""
+        with self._lock:
+            histograms = [(key, histogram.counts[:], histogram.sum,
+                           histogram.count)
+                          for key, histogram in self._histograms.items()]
+            counters = self._counters.items()
+
+        lines = []
+        for name in sorted(METRICS):
+            metric_type, description = METRICS[name]
+            if metric_type == "histogram":
+                samples = histogram_samples(
+                    name, histograms, self._buckets)
+            else:
+                samples = ["{}{} {}".format(name, format_labels(labels),
+                                            format_value(value))
+                           for (counter, labels), value in sorted(counters)
+                           if counter == name]
+            if samples:
+                lines.append("# HELP {} {}".format(name, description))
+                lines.append("# TYPE {} {}".format(name, metric_type))
+                lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+def histogram_samples(name, histograms, buckets):
+    samples = []
+    for (histogram, labels), counts, total, count in sorted(histograms):
+        if histogram != name:
+            continue
+        cumulative = 0
+        for bound, bucket_count in zip(buckets, counts):
+            cumulative += bucket_count
+            samples.append("{}_bucket{} {}".format(
+                name, format_labels(labels + (("le", format_value(bound)),)),
+                cumulative))
+        samples.append("{}_bucket{} {}".format(
+            name, format_labels(labels + (("le", "+Inf"),)), count))
+        samples.append("{}_sum{} {}".format(
+            name, format_labels(labels), format_value(total)))
+        samples.append("{}_count{} {}".format(
+            name, format_labels(labels), count))
+    return samples
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(labels):
+    """
+    >>> format_labels((("data_set", 'a"b'),))
+    '{data_set="a\\\\"b"}'
+    """
+    return "{" + ",".join('{}="{}"'.format(name, escape_label(value))
+                          for name, value in labels) + "}"
+
+
+def escape_label(value):
+    return unicode(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n").encode("utf-8")
+
+
+def format_value(value):
+    """
+    >>> format_value(1.0), format_value(0.25), format_value(3)
+    ('1', '0.25', '3')
+    """
+    return repr(value)[:-2] if isinstance(value, float) and \
+        value.is_integer() else repr(value)
+
+
+class RequestTimer(object):
+    """Adds up the time a request spends in each stage
+
+    >>> metrics = Metrics()
+    >>> timer = metrics.timer("foo", "query_data_set")
+    >>> with timer.stage("query"):
+    ...     with timer.stage("encode"):
+    ...         pass
+    >>> sorted(timer.totals)
+    ['encode', 'query']
+    >>> timer.finish(200)
+    >>> 'backdrop_requests_total{data_set="foo",endpoint="query_data_set",status="200"} 1' in metrics.render()
+    True
+    """
+    def __init__(self, metrics, data_set_id, endpoint):
+        self._metrics = metrics
+        self.data_set_id = data_set_id
+        self.endpoint = endpoint
+        self.started = time.time()
+        self.totals = {}
+        self._stack = []
+        self._finished = False
+
+    @contextmanager
+    def stage(self, name):
+        now = time.time()
+        if self._stack:
+            self._add(self._stack[-1], now)
+        self._stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.time()
+            self._add(self._stack.pop(), now)
+            if self._stack:
+                self._stack[-1][1] = now
+
+    def _add(self, entry, now):
+        name, started = entry
+        self.totals[name] = self.totals.get(name, 0.0) + now - started
+
+    def wrap(self, name, iterable):
+        """Time each step of an iterable as the stage"""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def finish(self, status):
+        """Observe the stage totals and count the request, once"""
+        if self._finished:
+            return
+        self._finished = True
+        data_set = {"data_set": self.data_set_id}
+        for name, total in self.totals.items():
+            self._metrics.observe("backdrop_stage_seconds",
+                                  dict(data_set, stage=name), total)
+        self._metrics.observe("backdrop_request_seconds",
+                              dict(data_set, endpoint=self.endpoint),
+                              self.elapsed())
+        self._metrics.increment("backdrop_requests_total",
+                                dict(data_set, endpoint=self.endpoint,
+                                     status=str(status)))
+
+
+class SampledProfiler(object):
+    """Profiles a sample of requests, dumping the slow ones
+
+    Profiles are written to directory as cProfile stats files named after
+    the request, readable with pstats. Nothing is profiled unless both a
+    rate and a directory are set.
+
+    >>> profiler = SampledProfiler()
+    >>> profiler.start() is None
+    True
+    """
+    def __init__(self, rate=0, slow=1.0, directory=None):
+        self.rate = rate
+        self.slow = slow
+        self.directory = directory
+
+    def start(self):
+        if not self.rate or not self.directory or \
+                random.random() >= self.rate:
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile, elapsed, name):
+        """Stop a profile, keeping it if the request was slow"""
+        if profile is None:
+            return
+        profile.disable()
+        if elapsed >= self.slow:
+            profile.dump_stats(os.path.join(self.directory, "{}-{}.prof".format(
+                name, int(time.time() * 1000))))
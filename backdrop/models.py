@@ -11,15 +11,28 @@ Example:
 
     # get a list of data sets
     data_sets.list()
+
+    # get a data set with a version that changes when its metadata does
+    # and its schema indexed for validation, all from the same load
+    version, data_set, schema_index = data_sets.entry(data_set_id)
 """
 import json
+import logging
 import os
+import threading
+import time
+
+from collections import namedtuple
+from os.path import isfile, join, splitext
+
+from .storage.connections import parse_write_concern
 
-from functools import partial
-from os.path import isfile, join
 
+__all__ = ["FilesystemDataSets", "DataSetEntry", "SchemaIndex",
+           "index_schema"]
 
-__all__ = ["FilesystemDataSets"]
+
+log = logging.getLogger(__name__)
 
 
 class DataSets(object):
@@ -40,23 +53,169 @@ def load_json_file(filename):
 
 
 def add_self_link(data_set):
-    data_set['self'] = "http://localhost:8080/data-sets/{}".format(data_set['id'])
-    return data_set
+    """
+    >>> add_self_link({"id": "foo"})
+    {'self': 'http://localhost:8080/data-sets/foo', 'id': 'foo'}
+    """
+    return dict(data_set.items() + [
+        ('self', "http://localhost:8080/data-sets/{}".format(data_set['id']))])
+
+
+class ReadOnlyDict(dict):
+    """A dict that cannot be changed once it is built
+
+    >>> data_set = ReadOnlyDict(id="foo")
+    >>> data_set["id"] = "bar"
+    Traceback (most recent call last):
+        ...
+    TypeError: data set metadata is read only
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("data set metadata is read only")
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+
+def freeze(value):
+    """Make read only copies of the dicts in a JSON value
+
+    Lists are left as lists so the value still validates as a JSON schema.
+    """
+    if isinstance(value, dict):
+        return ReadOnlyDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [freeze(item) for item in value]
+    return value
+
+
+def thaw(value):
+    """Make plain copies of the dicts in a frozen JSON value
+
+    >>> data_set = thaw(freeze({"id": "foo"}))
+    >>> data_set["id"] = "bar"
+    """
+    if isinstance(value, dict):
+        return dict((key, thaw(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [thaw(item) for item in value]
+    return value
+
+
+SchemaIndex = namedtuple("SchemaIndex", ["datetime_fields"])
+
+
+def index_schema(schema):
+    """Index the fields of a data set schema
+
+    >>> index_schema({"properties": {
+    ...     "_timestamp": {"type": "string", "format": "date-time"},
+    ...     "foo": {"type": "string"}}})
+    SchemaIndex(datetime_fields=('_timestamp',))
+    """
+    properties = schema.get("properties", {})
+    return SchemaIndex(
+        tuple(sorted(field_name for field_name, field in properties.items()
+                     if field.get("format") == "date-time")))
+
+
+DataSetEntry = namedtuple("DataSetEntry",
+                          ["version", "data_set", "schema_index"])
 
 
 class FilesystemDataSets(object):
+    """Data set metadata loaded from JSON files and held in memory
+
+    Files are checked for changes by their modification time, at most once
+    every CHECK_INTERVAL seconds, and only changed files are reloaded. A
+    file that fails to load is logged and its last good metadata kept.
+    Data sets are handed out as read only snapshots.
+
+    >>> import tempfile, shutil
+    >>> base_path = tempfile.mkdtemp()
+    >>> with open(join(base_path, "foo.json"), "w") as f:
+    ...     f.write('{"id": "foo"}')
+    >>> with open(join(base_path, "bar.json"), "w") as f:
+    ...     f.write('{"id": ')
+    >>> with open(join(base_path, "baz.json"), "w") as f:
+    ...     f.write('{"id": "baz", "write_concern": {"safe": true}}')
+    >>> data_sets = FilesystemDataSets(base_path, check_interval=0)
+    >>> [str(data_set["id"]) for data_set in data_sets.list()]
+    ['foo']
+    >>> with open(join(base_path, "foo.json"), "w") as f:
+    ...     f.write('{"id": "foo", "capped": ')
+    >>> os.utime(join(base_path, "foo.json"), (0, 0))
+    >>> str(data_sets.get("foo")["id"])
+    'foo'
+    >>> shutil.rmtree(base_path)
+    """
     BASE_PATH = "./data/data-sets"
+    CHECK_INTERVAL = 1
+
+    def __init__(self, base_path=None, check_interval=None, clock=time.time):
+        self._base_path = base_path or self.BASE_PATH
+        self._check_interval = check_interval \
+            if check_interval is not None else self.CHECK_INTERVAL
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._failed_versions = {}
+        self._checked_at = None
 
     def get(self, id):
-        file_path = "{}/{}.json".format(self.BASE_PATH, id)
-        if not os.path.isfile(file_path):
+        return self.entry(id).data_set
+
+    def entry(self, id):
+        """The version, data set and schema index of one load of a data set
+        """
+        try:
+            return self._refreshed_entries()[id]
+        except KeyError:
             raise NotFound
-        return add_self_link(load_json_file(file_path))
-
 
     def list(self):
-        abspath = partial(join, self.BASE_PATH)
-        return map(add_self_link,
-            map(load_json_file,
-                filter(isfile, 
-                    map(abspath, os.listdir(self.BASE_PATH)))))
+        entries = self._refreshed_entries()
+        return [entries[id].data_set for id in sorted(entries)]
+
+    def _refreshed_entries(self):
+        now = self._clock()
+        checked_at = self._checked_at
+        if checked_at is None or now - checked_at >= self._check_interval:
+            with self._lock:
+                if self._checked_at is checked_at:
+                    self._entries = self._load_changed(self._entries)
+                    self._checked_at = now
+        return self._entries
+
+    def _load_changed(self, entries):
+        """Return new entries, reusing those whose files are unchanged"""
+        loaded = {}
+        for file_name in os.listdir(self._base_path):
+            id, extension = splitext(file_name)
+            file_path = join(self._base_path, file_name)
+            if extension != ".json" or not isfile(file_path):
+                continue
+
+            version = os.path.getmtime(file_path)
+            entry = entries.get(id)
+            if entry is None or entry.version != version:
+                try:
+                    entry = load_entry(file_path, version)
+                except Exception as e:
+                    if self._failed_versions.get(id) != version:
+                        log.warning("Could not load data set %s: %s",
+                                    file_path, e)
+                        self._failed_versions[id] = version
+                    if entry is None:
+                        continue
+            loaded[id] = entry
+
+        return loaded
+
+
+def load_entry(file_path, version):
+    data_set = freeze(add_self_link(load_json_file(file_path)))
+    # Reject a bad write concern here rather than on every save
+    parse_write_concern(data_set)
+    return DataSetEntry(
+        version, data_set, index_schema(data_set.get("schema", {})))
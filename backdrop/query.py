@@ -1,7 +1,25 @@
-import jsonschema
+import base64
+import threading
+from collections import OrderedDict, namedtuple
+
+import bson
+from bson.errors import BSONError
+from jsonschema.validators import validator_for
+from werkzeug.datastructures import MultiDict
+from .models import freeze
 from .timeutils import parse_time_as_utc, parse_period
 
-__all__ = ['parse_query']
+__all__ = [
+    'parse_query', 'QueryPlans', 'split_response_args', 'collect_key',
+    'PageToken', 'page_token', 'page_sort_field', 'is_group_query'
+]
+
+
+# Query args that control how a response is written rather than the query
+RESPONSE_ARGS = ["format", "pretty"]
+
+# The most raw results a page can hold
+MAX_PAGE_SIZE = 100000
 
 
 def parse_query(query_args, schema):
@@ -18,6 +36,61 @@ def parse_query(query_args, schema):
     return query
 
 
+class QueryPlans(object):
+    """Query plans cached by data set, schema version and query string
+
+    A plan is built by the storage engine's plan function from the parsed
+    query, which it keeps as its query attribute. Repeated queries skip
+    validation, parsing and planning. Plans are shared between requests so
+    the parsed query is frozen and plans must not be changed.
+
+    >>> plans = QueryPlans()
+    >>> schema = {"properties": {"foo": {}}}
+    >>> plan = plans.get("foo", 1, MultiDict([("group_by", "foo")]), schema,
+    ...                  lambda query: ("plan", query))
+    >>> plan
+    ('plan', {'group_by': 'foo'})
+    >>> plan is plans.get("foo", 1, MultiDict([("group_by", "foo")]), schema,
+    ...                   lambda query: ("plan", query))
+    True
+    """
+    MAX_PLANS = 1024
+
+    def __init__(self, max_plans=None):
+        self._max_plans = max_plans or self.MAX_PLANS
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, data_set_id, version, query_args, schema, plan_query):
+        if "page_token" in query_args:
+            return plan_query(freeze(parse_query(query_args, schema)))
+
+        key = (data_set_id, version, normalise_args(query_args))
+        with self._lock:
+            plan = self._plans.pop(key, None)
+            if plan is not None:
+                self._plans[key] = plan
+                return plan
+
+        plan = plan_query(freeze(parse_query(query_args, schema)))
+
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self._max_plans:
+                self._plans.popitem(last=False)
+        return plan
+
+
+def normalise_args(query_args):
+    """Return a hashable form of query args that ignores their order
+
+    >>> normalise_args(MultiDict([("b", "2"), ("a", "1"), ("b", "1")]))
+    (('a', ('1',)), ('b', ('1', '2')))
+    """
+    return tuple(sorted((key, tuple(sorted(query_args.getlist(key))))
+                        for key in query_args.keys()))
+
+
 class ValidationError(StandardError):
     pass
 
@@ -63,16 +136,54 @@ query_schema = {
             "type": "array",
             "items": {"type": "string", "pattern": "^[a-z0-9_]+:(sum|count|set|mean)$"},
             "uniqueItems": True
+        },
+        "fill": {
+            "type": "array",
+            "maxItems": 1,
+            "items": {"enum": ["zero"]}
+        },
+        "fields": {
+            "type": "array",
+            "items": {"type": "string", "pattern": "^[a-z0-9_]+$"},
+            "uniqueItems": True
+        },
+        "page_size": {
+            "type": "array",
+            "maxItems": 1,
+            "items": {"type": "string", "pattern": "^[0-9]+$"}
+        },
+        "page_token": {
+            "type": "array",
+            "maxItems": 1,
+            "items": {"type": "string", "pattern": "^[A-Za-z0-9_-]+$"}
         }
     },
     "additionalProperties": False
 }
 
+query_validator = validator_for(query_schema)(query_schema)
+
+
+def split_response_args(args):
+    """Separate args controlling the response from the query args
+
+    >>> options, query_args = split_response_args(
+    ...     MultiDict([("pretty", "true"), ("limit", "1")]))
+    >>> options
+    {'pretty': 'true'}
+    >>> query_args
+    MultiDict([('limit', '1')])
+    """
+    query_args = MultiDict(args)
+    options = dict((key, query_args.pop(key))
+                   for key in RESPONSE_ARGS if key in query_args)
+    return options, query_args
+
 
 def validate_query_args(args):
     """Validate query args (from flask) against the schema above"""
     query_args = dict((key, args.getlist(key)) for key in args.keys())
-    jsonschema.validate(query_args, query_schema)
+    query_validator.validate(query_args)
 
 
 def boolify(value):
@@ -116,10 +227,39 @@ def parse_query_args(args):
         query["collect"] = []
         for collect in args.getlist("collect"):
             query["collect"].append(collect.split(":", 1))
+    if "fill" in args:
+        query["fill"] = args.get("fill")
+    if "fields" in args:
+        query["fields"] = args.getlist("fields")
+    if "page_size" in args:
+        query["page_size"] = args.get("page_size", type=int)
+    if "page_token" in args:
+        query["page_token"] = parse_page_token(args.get("page_token"))
     
     return query
 
 
+def is_group_query(query):
+    """
+    >>> is_group_query({"group_by": "foo"})
+    True
+    >>> is_group_query({"period": "week"})
+    True
+    >>> is_group_query({"foo": "bar"})
+    False
+    """
+    return bool(query.get("group_by") or query.get("period"))
+
+
+def collect_key(field, function):
+    """The name of a collected value in a result
+
+    >>> collect_key("foo", "sum")
+    'foo:sum'
+    """
+    return "{}:{}".format(field, function)
+
+
 def validate_query(query, schema):
     """Validate that the query is valid with respect to the provided shema"""
     
@@ -127,12 +267,13 @@ def validate_query(query, schema):
     if "_timestamp" not in schema['properties']:
         for field in ["start_at", "end_at", "period"]:
             if field in query:
-                raise
+                raise ValidationError(
+                    "Cannot use {}, data set has no _timestamp".format(field))
     
     # can filter on any core field
     for field, value in query.get("filter_by", {}).items():
         if field not in schema["properties"]:
-            raise
+            raise ValidationError("Cannot filter by {}, field not present".format(field))
 
     # can group on any core fields
     if "group_by" in query and query["group_by"] not in schema["properties"]:
@@ -146,3 +287,74 @@ def validate_query(query, schema):
     for field, function in query.get("collect", []):
         if field not in schema["properties"]:
             raise ValidationError("Cannot collect on {}, field not present".format(field))
+
+    # can only select fields of raw records, _id is always there
+    for field in query.get("fields", []):
+        if "group_by" in query or "period" in query or "collect" in query:
+            raise ValidationError("Cannot select fields in a grouped query")
+        if field != "_id" and field not in schema["properties"]:
+            raise ValidationError("Cannot select {}, field not present".format(field))
+
+    # can page through raw records, resuming after the same sort field
+    if "page_size" in query:
+        if "group_by" in query or "period" in query or "limit" in query:
+            raise ValidationError("Cannot page a grouped or limited query")
+        if not 0 < query["page_size"] <= MAX_PAGE_SIZE:
+            raise ValidationError("Page size must be from 1 to {}".format(
+                MAX_PAGE_SIZE))
+    if "page_token" in query:
+        if "page_size" not in query:
+            raise ValidationError("Cannot use a page token without page_size")
+        if query["page_token"].field != page_sort_field(query):
+            raise ValidationError("Page token is for a different sort")
+
+    # can only fill gaps in a period query with a start and an end
+    if "fill" in query:
+        for field in ["period", "start_at", "end_at"]:
+            if field not in query:
+                raise ValidationError("Cannot fill without {}".format(field))
+
+
+PageToken = namedtuple("PageToken", ["field", "value", "id"])
+
+
+def page_sort_field(query):
+    """The field pages are ordered by, before _id
+
+    >>> page_sort_field({"sort_by": {"field": "foo", "direction": "ascending"}})
+    'foo'
+    >>> page_sort_field({})
+    '_id'
+    """
+    return query["sort_by"]["field"] if "sort_by" in query else "_id"
+
+
+def page_token(result, query):
+    """An opaque token for the page after a result
+
+    It holds the result's sort field value and _id, so the next page starts
+    from the same place whatever has been saved since.
+
+    >>> parse_page_token(page_token({"_id": 1, "foo": "bar"},
+    ...     {"sort_by": {"field": "foo", "direction": "ascending"}}))
+    PageToken(field=u'foo', value=u'bar', id=1)
+    """
+    field = page_sort_field(query)
+    encoded = bson.BSON.encode(
+        {"f": field, "v": result.get(field), "i": result["_id"]})
+    return base64.urlsafe_b64encode(encoded).rstrip("=")
+
+
+def parse_page_token(token):
+    """
+    >>> parse_page_token("foo")
+    Traceback (most recent call last):
+        ...
+    ValidationError: Invalid page token
+    """
+    try:
+        decoded = bson.BSON(base64.urlsafe_b64decode(
+            str(token) + "=" * (-len(token) % 4))).decode()
+        return PageToken(decoded["f"], decoded["v"], decoded["i"])
+    except (BSONError, TypeError, ValueError, KeyError):
+        raise ValidationError("Invalid page token")
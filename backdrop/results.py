@@ -1,36 +1,233 @@
+import numbers
 import re
+from collections import defaultdict
 from functools import partial
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-__all__ = ['create_result_builder']
+from .query import collect_key
+from .storage.base import MISSING
+from .timeutils import timeseries
+
+
+__all__ = ['create_result_builder', 'fill_gaps']
+
+
+# Groups with at least this many values are reduced with numpy if available
+VECTORISE_THRESHOLD = 1000
 
 
 def create_result_builder(query):
-    """Return a function that builds result items
+    """Return a function that builds batches of results
 
+    - Apply collect functions the storage engine has not already applied
     - Add period limits to period queries
     - Strip meta fields for period start
+
+    Each stage works on whole columns of a ResultBatch.
     """
-    def result_builder(result):
-        result = add_period_limits(result, query)
-        result = strip_period_starts(result)
+    def result_builder(batch):
+        batch = collect_values(batch, query)
+        batch = add_period_limits(batch, query)
+        batch = strip_period_starts(batch)
 
-        return result
+        return batch
 
     return result_builder
 
 
-def strip_period_starts(result):
+def fill_gaps(results, query):
+    """Add zero filled results for empty periods if the query asks for them
+
+    Built results are filled from start_at to end_at. Grouped results are
+    filled separately for each group.
+
+    >>> from datetime import datetime
+    >>> from backdrop.timeutils import DAY
+    >>> query = {"period": DAY, "fill": "zero",
+    ...          "start_at": datetime(2012, 12, 12),
+    ...          "end_at": datetime(2012, 12, 14),
+    ...          "collect": [["foo", "sum"]]}
+    >>> [sorted(result.keys()) for result in fill_gaps([], query)]
+    [['_count', '_end_at', '_start_at', 'foo:sum'], ['_count', '_end_at', '_start_at', 'foo:sum']]
+    """
+    if query.get("fill") != "zero":
+        return results
+
+    group_by = query.get("group_by")
+    groups, results_by_group = [], {}
+    for result in results:
+        value = result.get(group_by) if group_by else None
+        if value not in results_by_group:
+            groups.append(value)
+            results_by_group[value] = []
+        results_by_group[value].append(result)
+
+    filled = []
+    for value in groups or [None]:
+        default = zero_result(query)
+        if group_by:
+            default[group_by] = value
+        filled.extend(timeseries(query["start_at"], query["end_at"],
+                                 query["period"], results_by_group.get(value, []),
+                                 default))
+    return filled
+
+
+def zero_result(query):
+    """The result for a period with no records
+
+    >>> sorted(zero_result({"collect": [["foo", "sum"], ["foo", "set"]]}).items())
+    [('_count', 0), ('foo:set', []), ('foo:sum', 0)]
+    """
+    zeros = {"sum": 0, "count": 0, "mean": None, "set": []}
+    result = {"_count": 0}
+    for field, function in query.get("collect", []):
+        result[collect_key(field, function)] = zeros[function]
+    return result
+
+
+def collect_values(batch, query):
+    """Apply collect functions to the lists of values in grouped results
+
+    Storage engines either compute collect functions themselves, returning
+    'field:function' keys which are left alone, or return all the values
+    for a field as a list which is reduced here.
+
+    >>> from backdrop.storage.base import ResultBatch
+    >>> batch = ResultBatch.from_rows([{"foo": [1, 2, None, 3]}])
+    >>> list(collect_values(batch,
+    ...     {"collect": [["foo", "sum"], ["foo", "count"]]}).rows())
+    [{'foo:sum': 6, 'foo:count': 3}]
+    >>> batch = ResultBatch.from_rows([{"foo:sum": 6}])
+    >>> list(collect_values(batch, {"collect": [["foo", "sum"]]}).rows())
+    [{'foo:sum': 6}]
+    """
+    functions_by_field = defaultdict(list)
+    for field, function in query.get("collect", []):
+        if collect_key(field, function) not in batch.fields:
+            functions_by_field[field].append(function)
+
+    collected, drop = [], []
+    for field, functions in functions_by_field.items():
+        if field not in batch.fields:
+            continue
+        column = batch.column(field)
+        reduced = [reduce_values(values, functions)
+                   if isinstance(values, list) else None
+                   for values in column]
+        if all(value is MISSING or reduction is not None
+               for value, reduction in zip(column, reduced)):
+            drop.append(field)
+        for function in functions:
+            collected.append((collect_key(field, function),
+                              [MISSING if reduction is None
+                               else reduction[function]
+                               for reduction in reduced]))
+
+    if collected:
+        batch = batch.with_columns(collected)
+    if drop:
+        batch = batch.without_fields(drop)
+    return batch
+
+
+def reduce_values(values, functions):
+    """Apply collect functions to a list of values in a single pass
+
+    Missing values are ignored, as are values that are not numbers when
+    summing or averaging, as Mongo's $sum and $avg do. Large numeric groups
+    are summed as a numpy array.
+
+    >>> sorted(reduce_values([1, 2, 2, None], ["sum", "mean", "set"]).items())
+    [('mean', 1.6666666666666667), ('set', [1, 2]), ('sum', 5)]
+    >>> sorted(reduce_values([1, "a", True, 2.5], ["sum", "mean", "count"]).items())
+    [('count', 4), ('mean', 1.75), ('sum', 3.5)]
+    >>> reduce_values([], ["sum", "count", "mean"])
+    {'count': 0, 'sum': 0, 'mean': None}
     """
-    >>> strip_period_starts({'foo': 'bar'})
-    {'foo': 'bar'}
-    >>> strip_period_starts({'_week_start_at': 'foo'})
-    {}
+    values = [value for value in values if value is not None]
+
+    numeric, total = [], 0
+    if "sum" in functions or "mean" in functions:
+        numeric = [value for value in values if is_number(value)]
+        total = sum_numbers(numeric)
+
+    reducers = {
+        "count": lambda: len(values),
+        "sum": lambda: total,
+        "mean": lambda: float(total) / len(numeric) if numeric else None,
+        "set": lambda: sorted(set(values)),
+    }
+    return dict((function, reducers[function]()) for function in functions)
+
+
+def is_number(value):
+    """
+    >>> is_number(1), is_number(1.5), is_number(True), is_number("1")
+    (True, True, False, False)
+    """
+    return isinstance(value, numbers.Number) and not isinstance(value, bool)
+
+
+# Largest magnitude an int64 sum can reach without wrapping
+INT64_MAX = 2 ** 63 - 1
+
+
+def sum_numbers(values):
+    """Sum numbers, with numpy when there are enough and it gives the same
+    answer as Python
+
+    >>> sum_numbers([2 ** 62] * VECTORISE_THRESHOLD) == 2 ** 62 * VECTORISE_THRESHOLD
+    True
+    >>> sum_numbers([1, 2.5])
+    3.5
+    """
+    column = as_numeric_column(values)
+    if column is None:
+        return sum(values)
+    if column.dtype == numpy.int64:
+        largest = max(int(column.max()), -int(column.min()))
+        if largest * len(column) > INT64_MAX:
+            return sum(values)
+    return column.sum().item()
+
+
+def as_numeric_column(values):
+    """Return values as a numpy array if it is worth vectorising them
+
+    Only int64 and float64 columns are returned, anything else is summed
+    by Python.
+
+    >>> as_numeric_column([1, 2])
+    >>> as_numeric_column(range(VECTORISE_THRESHOLD)).dtype
+    dtype('int64')
+    >>> as_numeric_column([2 ** 64] * VECTORISE_THRESHOLD)
+    >>> as_numeric_column(["foo"] * VECTORISE_THRESHOLD)
     """
-    return dict(
-            (field, value)
-            for field, value in result.items()
-            if not is_period_start(field))
+    if numpy is None or len(values) < VECTORISE_THRESHOLD:
+        return None
+    column = numpy.asarray(values)
+    if column.dtype not in (numpy.int64, numpy.float64):
+        return None
+    return column
+
+
+def strip_period_starts(batch):
+    """
+    >>> from backdrop.storage.base import ResultBatch
+    >>> batch = ResultBatch.from_rows([{'foo': 'bar', '_week_start_at': 'foo'}])
+    >>> strip_period_starts(batch).fields
+    ['foo']
+    """
+    period_starts = [field for field in batch.fields if is_period_start(field)]
+    return batch.without_fields(period_starts) if period_starts else batch
+
+
+PERIOD_START = re.compile('^_.*_start_at$')
 
 
 def is_period_start(field):
@@ -40,13 +237,24 @@ def is_period_start(field):
     >>> is_period_start("_week_start_at")
     True
     """
-    return bool(re.search('^_.*_start_at$', field))
+    return bool(PERIOD_START.search(field))
 
 
-def add_period_limits(result, query):
+def add_period_limits(batch, query):
+    """Add _start_at and _end_at columns to batches from period queries
+
+    Each distinct period start only has its end worked out once.
+    """
     period = query.get('period')
-    if period:
-        start_at = result[period.start_at_key]
-        end_at = period.end(start_at)
-        return dict(result.items() + [('_start_at', start_at), ('_end_at', end_at)])
-    return result
+    if period and period.start_at_key in batch.fields:
+        start_ats = batch.column(period.start_at_key)
+        end_ats = {}
+        for start_at in start_ats:
+            if start_at not in end_ats and start_at is not MISSING:
+                end_ats[start_at] = period.end(start_at)
+        return batch.with_columns([
+            ('_start_at', start_ats),
+            ('_end_at', [end_ats.get(start_at, MISSING)
+                         for start_at in start_ats]),
+        ])
+    return batch
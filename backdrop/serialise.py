@@ -0,0 +1,217 @@
+"""
+This module encodes responses as JSON
+
+Values JSON has no type for, datetimes and ObjectIds, are converted before
+encoding rather than through a hook called for each one, a column at a time
+for batches of results. Output is compact unless pretty is asked for.
+
+When ujson is installed compact output is encoded with it. Values the two
+encoders would write differently, such as floats written with an exponent,
+are encoded with the standard library instead so the output is byte for
+byte the same either way.
+
+Example:
+    # a compact JSON string
+    encode({"_timestamp": datetime(2012, 12, 12)})
+
+    # an indented JSON string
+    encode(data_sets, pretty=True)
+
+    # a JSON string for each result in some batches of results
+    encode_batches(batches)
+"""
+import datetime
+import json
+from itertools import imap
+
+from bson import ObjectId
+
+from .storage.base import ResultBatch, MISSING
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+__all__ = ['encode', 'encode_batches', 'prepare', 'prepare_batch']
+
+
+CONVERTERS = {
+    datetime.datetime: datetime.datetime.isoformat,
+    ObjectId: str,
+}
+
+PLAIN_TYPES = frozenset([str, unicode, int, long, bool, type(None)])
+FLOAT_TYPES = frozenset([float])
+CONVERTED_TYPES = frozenset(CONVERTERS)
+STRING_TYPES = (str, unicode)
+MISSING_TYPE = type(MISSING)
+
+
+class JsonEncoder(json.JSONEncoder):
+    """Converts values nested in results that were not prepared"""
+
+    def default(self, obj):
+        for converter_type, convert in CONVERTERS.items():
+            if isinstance(obj, converter_type):
+                return convert(obj)
+        return json.JSONEncoder.default(self, obj)
+
+
+COMPACT = JsonEncoder(separators=(',', ':'))
+PRETTY = JsonEncoder(indent=2, separators=(',', ': '))
+
+# Older versions of ujson write floats at a fixed precision
+if ujson is not None and ujson.dumps(1.0 / 3) != COMPACT.encode(1.0 / 3):
+    ujson = None
+
+
+def encode(value, pretty=False):
+    """Encode a value as JSON
+
+    >>> encode({"_timestamp": datetime.datetime(2012, 12, 12)})
+    '{"_timestamp":"2012-12-12T00:00:00"}'
+    >>> print encode([1, 2], pretty=True)
+    [
+      1,
+      2
+    ]
+    """
+    if pretty or ujson is None:
+        return (PRETTY if pretty else COMPACT).encode(value)
+    value, plain = prepare(value)
+    return dumps(value, pretty, plain)
+
+
+def encode_batches(batches, pretty=False):
+    """Encode each result in an iterable of batches as a JSON string
+
+    >>> list(encode_batches([ResultBatch.from_rows([{"a": 1}, {"a": 0.5}])]))
+    ['{"a":1}', '{"a":0.5}']
+    """
+    for batch in batches:
+        batch, plain = prepare_batch(batch)
+        for row in batch.rows():
+            yield dumps(row, pretty, plain)
+
+
+def dumps(value, pretty=False, plain=False):
+    """Encode a prepared value, using ujson if it is plain"""
+    if plain and not pretty and ujson is not None:
+        try:
+            # ujson leaves DEL unescaped, it only occurs inside strings
+            return ujson.dumps(value, ensure_ascii=True,
+                               escape_forward_slashes=False) \
+                .replace('\x7f', '\\u007f')
+        except (OverflowError, ValueError, TypeError):
+            # eg. integers of more than 64 bits
+            pass
+    return (PRETTY if pretty else COMPACT).encode(value)
+
+
+def prepare(value):
+    """Convert the values in a JSON value that JSON has no type for
+
+    Returns the converted value and whether it is plain, that is whether
+    ujson and the standard library encode it the same way.
+
+    >>> prepare([datetime.datetime(2012, 12, 12), 0.5])
+    (['2012-12-12T00:00:00', 0.5], True)
+    >>> prepare({"foo": 1e-05})
+    ({'foo': 1e-05}, False)
+    """
+    value_type = type(value)
+    if value_type in PLAIN_TYPES:
+        return value, True
+    if value_type is float:
+        return value, is_plain_float(value)
+    if value_type in CONVERTERS:
+        return CONVERTERS[value_type](value), True
+
+    if isinstance(value, dict):
+        prepared, plain = {}, True
+        for key, item in value.iteritems():
+            prepared[key], item_plain = prepare(item)
+            plain = plain and item_plain and isinstance(key, STRING_TYPES)
+        return prepared, plain
+    if isinstance(value, (list, tuple)):
+        prepared, plain = [], True
+        for item in value:
+            item, item_plain = prepare(item)
+            prepared.append(item)
+            plain = plain and item_plain
+        return prepared, plain
+
+    for converter_type, convert in CONVERTERS.items():
+        if isinstance(value, converter_type):
+            return convert(value), True
+    # Leave anything else for the standard library to encode or reject
+    return value, False
+
+
+def prepare_batch(batch):
+    """Convert the columns of a batch that have values JSON has no type for
+
+    Columns are checked by the types of their values. Columns of plain
+    types are passed on as they are and columns of datetimes or ObjectIds
+    are converted in one go. Other columns are only walked value by value if
+    ujson is installed, otherwise they are left to the encoder.
+
+    >>> batch, plain = prepare_batch(ResultBatch.from_rows(
+    ...     [{"a": datetime.datetime(2012, 12, 12)}, {"b": 1}]))
+    >>> list(batch.rows()), plain
+    ([{'a': '2012-12-12T00:00:00'}, {'b': 1}], True)
+    """
+    plain = all(isinstance(field, STRING_TYPES) for field in batch.fields)
+    columns = []
+    for column in batch.columns:
+        types = set(imap(type, column))
+        has_missing = MISSING_TYPE in types
+        types.discard(MISSING_TYPE)
+        types -= PLAIN_TYPES
+
+        if not types:
+            columns.append(column)
+            continue
+
+        if types == FLOAT_TYPES:
+            plain = plain and ujson is not None and all(
+                is_plain_float(value) for value in column
+                if type(value) is float)
+        elif len(types) == 1 and not has_missing and types <= CONVERTED_TYPES:
+            column = map(CONVERTERS[types.pop()], column)
+        elif types <= CONVERTED_TYPES:
+            column = [CONVERTERS[type(value)](value)
+                      if type(value) in CONVERTERS else value
+                      for value in column]
+        elif ujson is None:
+            plain = False
+        else:
+            column, column_plain = prepare_column(column)
+            plain = plain and column_plain
+        columns.append(column)
+
+    return ResultBatch(batch.fields, columns, batch.size), plain
+
+
+def prepare_column(column):
+    prepared, plain = [], True
+    for value in column:
+        if value is not MISSING:
+            value, value_plain = prepare(value)
+            plain = plain and value_plain
+        prepared.append(value)
+    return prepared, plain
+
+
+def is_plain_float(value):
+    """Whether a float is written without an exponent
+
+    Python writes floats outside this range with an exponent, ujson does not.
+    NaN and infinity are not plain.
+
+    >>> is_plain_float(0.0), is_plain_float(1.5), is_plain_float(1e16)
+    (True, True, False)
+    """
+    return value == 0 or 1e-4 <= abs(value) < 1e16
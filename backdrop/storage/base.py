@@ -1,5 +1,11 @@
+import datetime
+from itertools import chain, izip, islice
 
-__all__ = ["Data"]
+from ..timeutils import as_utc
+
+
+__all__ = ["Data", "ResultBatch", "MISSING", "batches", "iter_rows",
+           "sort_groups"]
 
 class Data(object):
     def create(self, data_set_id, schema):
@@ -10,10 +16,180 @@ class Data(object):
         """Check if a data set exists"""
         pass
 
-    def save(self, data_set_id, record):
-        """Save a record to the data set"""
+    def save(self, data_set_id, records, data_set=None):
+        """Save records to the data set
+
+        The data set metadata is passed for storage features configured
+        per data set. Returns the number of records saved and a list of the
+        indexes of any records that could not be saved.
+        """
         pass
 
-    def query(self, data_set_id, query):
-        """Query against a data set"""
+    def plan(self, query):
+        """Build a plan for a parsed query, kept as its query attribute
+
+        Plans are cached and reused for repeated queries.
+        """
         pass
+
+    def query(self, data_set_id, query, data_set=None, plan=None):
+        """Query against a data set, using its plan if one is given
+
+        Returns an iterable of ResultBatch which may be read lazily.
+        """
+        pass
+
+
+# Marks a field that a result in a batch does not have
+MISSING = type("Missing", (object,), {"__repr__": lambda self: "MISSING"})()
+
+
+class ResultBatch(object):
+    """A batch of results held as a list of fields and a column per field
+
+    Stages that work on results change whole columns and share the ones
+    they leave alone. Results only become dicts again when rows is called.
+
+    >>> batch = ResultBatch.from_rows([{"a": 1, "b": 2}, {"a": 3}])
+    >>> batch.column("b")
+    [2, MISSING]
+    >>> list(batch.without_fields(["a"]).rows())
+    [{'b': 2}, {}]
+    """
+    __slots__ = ("fields", "columns", "size")
+
+    def __init__(self, fields, columns, size):
+        self.fields = fields
+        self.columns = columns
+        self.size = size
+
+    @classmethod
+    def from_rows(cls, rows):
+        rows = list(rows)
+        fields, seen = [], set()
+        for row in rows:
+            for field in row:
+                if field not in seen:
+                    seen.add(field)
+                    fields.append(field)
+        columns = [[row.get(field, MISSING) for row in rows]
+                   for field in fields]
+        return cls(fields, columns, len(rows))
+
+    def __len__(self):
+        return self.size
+
+    def column(self, field):
+        return self.columns[self.fields.index(field)]
+
+    def with_columns(self, columns):
+        """Return a batch with (field, column) pairs added or replaced"""
+        fields, existing = list(self.fields), list(self.columns)
+        for field, column in columns:
+            if field in fields:
+                existing[fields.index(field)] = column
+            else:
+                fields.append(field)
+                existing.append(column)
+        return ResultBatch(fields, existing, self.size)
+
+    def without_fields(self, drop):
+        keep = [position for position, field in enumerate(self.fields)
+                if field not in drop]
+        return ResultBatch([self.fields[position] for position in keep],
+                           [self.columns[position] for position in keep],
+                           self.size)
+
+    def rows(self):
+        if not self.columns:
+            return iter([{} for _ in xrange(self.size)])
+        return self._rows()
+
+    def _rows(self):
+        fields = self.fields
+        for values in izip(*self.columns):
+            yield dict((field, value) for field, value in izip(fields, values)
+                       if value is not MISSING)
+
+
+def batches(records, size):
+    """Split an iterable of records into lists of at most size records
+
+    Each batch is paired with the index of its first record.
+
+    >>> list(batches(range(5), 2))
+    [(0, [0, 1]), (2, [2, 3]), (4, [4])]
+    >>> list(batches([], 2))
+    []
+    """
+    records = iter(records)
+    offset = 0
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield offset, batch
+        offset += len(batch)
+
+
+def batches_of(rows, size):
+    """Group an iterable of rows into batches of at most size results
+
+    >>> [len(batch) for batch in batches_of([{"a": 1}] * 5, 2)]
+    [2, 2, 1]
+    """
+    for _, batch in batches(rows, size):
+        yield ResultBatch.from_rows(batch)
+
+
+def iter_rows(batches):
+    """Turn an iterable of batches back into result dicts"""
+    return chain.from_iterable(batch.rows() for batch in batches)
+
+
+def convert_datetimes_to_utc(batch):
+    """Convert datatime columns in a batch of results to UTC
+
+    Storage may hand back naive datetimes or drop offsets, we don't.
+
+    >>> batch = ResultBatch.from_rows([
+    ...     {'foo': 'bar', 'baz': datetime.datetime(2012, 12, 12)}])
+    >>> list(convert_datetimes_to_utc(batch).rows())
+    [{'foo': 'bar', 'baz': datetime.datetime(2012, 12, 12, 0, 0, tzinfo=<UTC>)}]
+    """
+    def time_as_utc(value):
+        if isinstance(value, datetime.datetime):
+            return as_utc(value)
+        return value
+
+    def has_datetimes(column):
+        return any(isinstance(value, datetime.datetime) for value in column)
+
+    converted = [(field, map(time_as_utc, column))
+                 for field, column in izip(batch.fields, batch.columns)
+                 if has_datetimes(column)]
+
+    return batch.with_columns(converted) if converted else batch
+
+
+def sort_groups(groups, keys, sort_by=None):
+    """Sort grouped results by each key ascending, sort_by's key first
+
+    A sort_by field that is not a group key is ignored.
+
+    >>> groups = [{"a": 1, "b": 2}, {"a": 2, "b": 1}, {"a": 1, "b": 1}]
+    >>> [(g["a"], g["b"]) for g in sort_groups(groups, ["a", "b"])]
+    [(1, 1), (1, 2), (2, 1)]
+    >>> [(g["a"], g["b"]) for g in sort_groups(groups, ["a", "b"],
+    ...     {"field": "b", "direction": "descending"})]
+    [(1, 2), (1, 1), (2, 1)]
+    """
+    groups = list(groups)
+    sort_field = sort_by["field"] if sort_by else None
+    for key in reversed(keys):
+        if key != sort_field:
+            groups.sort(key=lambda group: group[key])
+    if sort_field in keys:
+        groups.sort(key=lambda group: group[sort_field],
+                    reverse=sort_by["direction"] == "descending")
+    return groups
@@ -0,0 +1,144 @@
+"""
+Connection settings for MongoData
+
+Writes go through one pooled client. Queries go through a second client
+when a read preference other than primary is configured, so they can be
+served by secondaries, and reuse the write client otherwise. Reads from
+secondaries may lag recent writes.
+
+A data set can ask for its writes to be acknowledged differently in its
+metadata, eg.
+
+    "write_concern": {
+        "w": "majority",
+        "wtimeout": 5000
+    }
+
+Example:
+    config = ConnectionConfig(pool_size=50, socket_timeout=30,
+                              replica_set="backdrop",
+                              read_preference="secondaryPreferred")
+
+    # seeds may be one "host:port" or a list of them
+    client, read_client = connect(["mongo1", "mongo2"], config)
+"""
+from pymongo import MongoClient, MongoReplicaSetClient
+
+
+__all__ = [
+    'ConnectionConfig', 'connect', 'client_options', 'parse_write_concern',
+    'READ_PREFERENCES'
+]
+
+
+READ_PREFERENCES = [
+    "primary",
+    "primaryPreferred",
+    "secondary",
+    "secondaryPreferred",
+    "nearest",
+]
+
+WRITE_CONCERN_OPTIONS = frozenset(["w", "wtimeout", "j", "fsync"])
+
+
+class ConnectionConfig(object):
+    """Pool size, timeouts in seconds, replica set and read preference
+
+    write_concern is the default for data sets that do not set their own.
+    """
+    POOL_SIZE = 100
+    CONNECT_TIMEOUT = 20
+
+    def __init__(self, pool_size=None, connect_timeout=None,
+                 socket_timeout=None, wait_queue_timeout=None,
+                 replica_set=None, read_preference="primary",
+                 write_concern=None):
+        if read_preference not in READ_PREFERENCES:
+            raise ValueError(
+                "Unknown read preference {}".format(read_preference))
+        self.pool_size = pool_size or self.POOL_SIZE
+        self.connect_timeout = connect_timeout or self.CONNECT_TIMEOUT
+        self.socket_timeout = socket_timeout
+        self.wait_queue_timeout = wait_queue_timeout
+        self.replica_set = replica_set
+        self.read_preference = read_preference
+        self.write_concern = validate_write_concern(write_concern or {"w": 1})
+
+
+def connect(host, config=None):
+    """Create the clients for writes and for queries
+
+    Returns the same client twice when queries read from the primary.
+    """
+    config = config or ConnectionConfig()
+    hosts = [host] if isinstance(host, basestring) else list(host)
+
+    client = MongoClient(hosts, **client_options(config))
+    if config.read_preference == "primary":
+        return client, client
+
+    options = client_options(config, read=True)
+    if config.replica_set is not None:
+        read_client = MongoReplicaSetClient(",".join(hosts), **options)
+    else:
+        read_client = MongoClient(hosts, **options)
+    return client, read_client
+
+
+def client_options(config, read=False):
+    """The keyword arguments for a client with a config
+
+    >>> sorted(client_options(ConnectionConfig(socket_timeout=1.5)).items())
+    [('connectTimeoutMS', 20000), ('maxPoolSize', 100), ('socketTimeoutMS', 1500), ('w', 1)]
+    >>> client_options(ConnectionConfig(read_preference="secondary"),
+    ...                read=True)["readPreference"]
+    'secondary'
+    """
+    options = {
+        "maxPoolSize": config.pool_size,
+        "connectTimeoutMS": milliseconds(config.connect_timeout),
+    }
+    if config.socket_timeout is not None:
+        options["socketTimeoutMS"] = milliseconds(config.socket_timeout)
+    if config.wait_queue_timeout is not None:
+        options["waitQueueTimeoutMS"] = milliseconds(config.wait_queue_timeout)
+    if config.replica_set is not None:
+        options["replicaSet"] = config.replica_set
+    if read:
+        options["readPreference"] = config.read_preference
+    else:
+        options.update(config.write_concern)
+    return options
+
+
+def parse_write_concern(data_set):
+    """Return the write concern a data set sets for its writes, or None
+
+    >>> parse_write_concern({}) is None
+    True
+    >>> parse_write_concern({"write_concern": {"w": "majority"}})
+    {'w': 'majority'}
+    """
+    write_concern = (data_set or {}).get("write_concern")
+    if write_concern is None:
+        return None
+    return validate_write_concern(write_concern)
+
+
+def validate_write_concern(write_concern):
+    """
+    >>> validate_write_concern({"safe": True})
+    Traceback (most recent call last):
+        ...
+    ValueError: Unknown write concern options safe
+    """
+    unknown = set(write_concern) - WRITE_CONCERN_OPTIONS
+    if unknown:
+        raise ValueError("Unknown write concern options {}".format(
+            ", ".join(sorted(unknown))))
+    return dict(write_concern)
+
+
+def milliseconds(seconds):
+    return int(seconds * 1000)
@@ -0,0 +1,151 @@
+"""
+Index planning for data sets stored in Mongo
+
+Indexes are planned from a data set's schema when it is created and,
+optionally, from the shape of the queries made against it. Query indexes
+follow the equality, sort, range rule: fields filtered on by value first,
+then the fields results are grouped or sorted by, with _id for pages, then
+_timestamp for start_at and end_at.
+
+Example:
+    # indexes every data set with this schema should have
+    plan_schema_indexes(schema)
+
+    # indexes a set of queries would need
+    plan_workload_indexes(queries)
+
+    # planned indexes not covered by a collection's index_information()
+    missing_indexes(planned, collection.index_information())
+"""
+from collections import Counter
+
+import pymongo
+
+from ..timeutils import PERIODS
+
+
+__all__ = [
+    'plan_schema_indexes', 'plan_query_index', 'plan_workload_indexes',
+    'missing_indexes'
+]
+
+
+def plan_schema_indexes(schema):
+    """Plan the indexes a data set needs whatever is queried
+
+    - A single field index for each required field
+    - _timestamp, for start_at and end_at range filters
+    - Each period start meta field with _timestamp, for period queries
+
+    >>> for index in plan_schema_indexes({
+    ...         "properties": {"_timestamp": {}, "foo": {}},
+    ...         "required": ["foo"]})[:3]:
+    ...     print index
+    [('foo', 1)]
+    [('_timestamp', 1)]
+    [('_hour_start_at', 1), ('_timestamp', 1)]
+    """
+    properties = schema.get("properties", {})
+    required = schema.get("required", [])
+
+    indexes = [[(field_name, pymongo.ASCENDING)]
+               for field_name in sorted(properties)
+               if field_name in required and field_name != "_timestamp"]
+
+    if "_timestamp" in properties:
+        indexes.append([("_timestamp", pymongo.ASCENDING)])
+        for period in PERIODS:
+            indexes.append([(period.start_at_key, pymongo.ASCENDING),
+                            ("_timestamp", pymongo.ASCENDING)])
+
+    return indexes
+
+
+def plan_query_index(query):
+    """Plan the index that best serves a single parsed query
+
+    >>> from backdrop.timeutils import WEEK
+    >>> plan_query_index({"filter_by": {"foo": "bar"}, "period": WEEK,
+    ...                   "start_at": "2012-12-12"})
+    [('foo', 1), ('_week_start_at', 1), ('_timestamp', 1)]
+    >>> plan_query_index({"sort_by": {"field": "foo",
+    ...                               "direction": "descending"}})
+    [('foo', -1)]
+    >>> plan_query_index({"page_size": 10, "sort_by": {
+    ...     "field": "foo", "direction": "ascending"}})
+    [('foo', 1), ('_id', 1)]
+    >>> plan_query_index({})
+    """
+    fields = []
+
+    for field in sorted(query.get("filter_by", {})):
+        fields.append((field, pymongo.ASCENDING))
+
+    if query.get("group_by") or query.get("period"):
+        if query.get("group_by"):
+            fields.append((query["group_by"], pymongo.ASCENDING))
+        if query.get("period"):
+            fields.append((query["period"].start_at_key, pymongo.ASCENDING))
+    elif query.get("sort_by"):
+        direction = pymongo.DESCENDING \
+            if query["sort_by"]["direction"] == "descending" \
+            else pymongo.ASCENDING
+        fields.append((query["sort_by"]["field"], direction))
+        if "page_size" in query:
+            # pages are sorted by _id within a sort value
+            fields.append(("_id", direction))
+
+    if query.get("start_at") or query.get("end_at"):
+        fields.append(("_timestamp", pymongo.ASCENDING))
+
+    index, seen = [], set()
+    for field, direction in fields:
+        if field not in seen:
+            index.append((field, direction))
+            seen.add(field)
+
+    return index or None
+
+
+def plan_workload_indexes(queries, min_count=1):
+    """Plan the indexes for a set of queries, most needed first
+
+    Indexes needed by fewer than min_count queries are left out.
+
+    >>> plan_workload_indexes([{"group_by": "foo"}, {"group_by": "foo"},
+    ...                        {"group_by": "bar"}], min_count=2)
+    [[('foo', 1)]]
+    """
+    counts = Counter(tuple(index) for index in map(plan_query_index, queries)
+                     if index is not None)
+    return [list(index) for index, count in counts.most_common()
+            if count >= min_count]
+
+
+def missing_indexes(planned, index_information):
+    """Return the planned indexes that no existing index covers
+
+    An existing index covers a planned one if the planned fields are a
+    prefix of it, in the same or the exact reverse directions.
+
+    >>> existing = {"_id_": {"key": [("_id", 1)]},
+    ...             "foo_1_bar_1": {"key": [("foo", 1), ("bar", 1)]}}
+    >>> missing_indexes([[("foo", -1)], [("bar", 1)]], existing)
+    [[('bar', 1)]]
+    """
+    existing = [list(info["key"]) for info in index_information.values()]
+
+    def reverse(index):
+        return [(field, -direction) for field, direction in index]
+
+    def is_covered(index):
+        return any(key[:len(index)] in (index, reverse(index))
+                   for key in existing)
+
+    missing = []
+    for index in planned:
+        index = list(index)
+        if not is_covered(index) and index not in missing:
+            missing.append(index)
+    return missing
+
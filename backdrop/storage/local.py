@@ -0,0 +1,509 @@
+"""
+An embedded storage engine that keeps data sets in local files
+
+Each data set is a directory of append-only partitions, one per month of
+_timestamp plus one for records without a _timestamp. A partition is a file
+of BSON documents, read through mmap, and a _timestamp index file of
+(timestamp, offset) pairs which is loaded into memory. Queries with a time
+range only open the partitions it overlaps and use the index to find the
+records in range.
+
+Appends take an exclusive lock on the partition file and reads catch up
+with whatever has been appended since, so several processes can share a
+directory. A data set that was never created reads as empty and is
+created by its first save, as a Mongo collection is.
+
+Filtering, grouping, sorting, limits and periods follow MongoData. Grouped
+results carry the values of collected fields as lists for the results layer
+to reduce. Data sets are not capped and rollups are not kept.
+
+Example:
+    data = LocalData("/var/lib/backdrop")
+
+    data.create(data_set_id, capped, size, schema)
+    saved, failed = data.save(data_set_id, records)
+
+    for batch in data.query(data_set_id, query):
+        ...
+"""
+import calendar
+import errno
+import fcntl
+import heapq
+import json
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left
+from collections import namedtuple, OrderedDict
+from contextlib import closing, contextmanager
+from functools import partial
+from itertools import chain, islice, ifilter, imap
+from os.path import isdir, isfile, join
+
+import bson
+from bson import ObjectId
+from bson.errors import BSONError
+
+from .base import Data, batches, batches_of, convert_datetimes_to_utc, \
+    sort_groups
+from .partitions import month_key, overlaps
+from ..query import page_sort_field
+from ..timeutils import as_utc
+
+
+__all__ = ["LocalData"]
+
+
+DEFAULT_BATCH_SIZE = 1000
+
+META_FILE = "meta.json"
+DATA_EXTENSION = ".bson"
+INDEX_EXTENSION = ".idx"
+
+# Partition for records without a _timestamp
+UNTIMED = "untimed"
+
+# Documents decoded together when a whole partition is read
+DECODE_BATCH = 1000
+
+
+class LocalData(Data):
+    """
+    >>> import tempfile, shutil
+    >>> from datetime import datetime
+    >>> from backdrop.timeutils import UTC
+    >>> from backdrop.storage.base import iter_rows
+    >>> base_path = tempfile.mkdtemp()
+    >>> data = LocalData(base_path)
+    >>> data.create("foo", False, 0, {})
+    >>> data.save("foo", [
+    ...     {"_timestamp": datetime(2012, 12, 12, tzinfo=UTC), "a": 1},
+    ...     {"_timestamp": datetime(2013, 1, 12, tzinfo=UTC), "a": 2}])
+    (2, [])
+    >>> query = {"start_at": datetime(2013, 1, 1, tzinfo=UTC)}
+    >>> [row["a"] for row in iter_rows(data.query("foo", query))]
+    [2]
+    >>> shutil.rmtree(base_path)
+    """
+    def __init__(self, base_path, batch_size=DEFAULT_BATCH_SIZE):
+        self._base_path = base_path
+        self._batch_size = batch_size
+        self._data_sets = {}
+        self._lock = threading.Lock()
+
+    def exists(self, data_set_id):
+        return isfile(join(self._data_set_path(data_set_id), META_FILE))
+
+    def create(self, data_set_id, capped, size, schema):
+        path = self._data_set_path(data_set_id)
+        make_dirs(path)
+        with open(join(path, META_FILE), "w") as f:
+            json.dump({"capped": capped, "size": size, "schema": schema}, f)
+
+    def save(self, data_set_id, records, data_set=None):
+        """Append records to the partitions for their _timestamp
+
+        Records that cannot be encoded are counted as failed.
+        """
+        make_dirs(self._data_set_path(data_set_id))
+        data_set = self._data_set(data_set_id)
+        saved, failed = 0, []
+        for offset, batch in batches(records, self._batch_size):
+            by_partition = OrderedDict()
+            for index, record in enumerate(batch, offset):
+                record.setdefault("_id", ObjectId())
+                try:
+                    document = bson.BSON.encode(record)
+                except (BSONError, TypeError, ValueError):
+                    failed.append(index)
+                    continue
+                key, timestamp = partition_key(record.get("_timestamp"))
+                by_partition.setdefault(key, []).append((document, timestamp))
+
+            for key, documents in by_partition.items():
+                data_set.partition(key).append(documents)
+                saved += len(documents)
+
+        return saved, failed
+
+    def plan(self, query):
+        return plan_query(query)
+
+    def query(self, data_set_id, query, data_set=None, plan=None):
+        """Return an iterator over batches of results, read lazily"""
+        plan = plan or plan_query(query)
+        records = self._data_set(data_set_id).read(plan.start_at, plan.end_at)
+        if plan.filter_by:
+            records = ifilter(partial_match(plan.filter_by), records)
+        if plan.after is not None:
+            records = ifilter(plan.after, records)
+
+        if plan.group_keys:
+            results = group_records(records, plan)
+        else:
+            results = sort_records(records, plan)
+            if plan.fields:
+                results = imap(partial(select_fields, plan.fields), results)
+
+        return imap(convert_datetimes_to_utc,
+                    batches_of(results, self._batch_size))
+
+    def _data_set_path(self, data_set_id):
+        return join(self._base_path, data_set_id)
+
+    def _data_set(self, data_set_id):
+        with self._lock:
+            if data_set_id not in self._data_sets:
+                self._data_sets[data_set_id] = \
+                    LocalDataSet(self._data_set_path(data_set_id))
+            return self._data_sets[data_set_id]
+
+
+class LocalDataSet(object):
+    """The partitions of a data set, loaded as they are first used
+
+    The directory is listed again on each read, to find partitions other
+    processes have created.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._partitions = {}
+
+    def partition(self, key):
+        with self._lock:
+            if key not in self._partitions:
+                self._partitions[key] = Partition(join(self._path, key))
+            return self._partitions[key]
+
+    def read(self, start_at=None, end_at=None):
+        """Yield records in the time range, a partition at a time
+
+        Partitions are read oldest first, with records in the order they
+        were saved. Records without a _timestamp are only read when there
+        is no time range.
+        """
+        with self._lock:
+            self._find_partitions()
+            partitions = sorted(self._partitions.items())
+
+        if start_at is None and end_at is None:
+            untimed = [p for key, p in partitions if key == UNTIMED]
+            timed = [p for key, p in partitions if key != UNTIMED]
+            return chain.from_iterable(
+                partition.read() for partition in untimed + timed)
+
+        start = to_micros(start_at) if start_at is not None else None
+        end = to_micros(end_at) if end_at is not None else None
+        return chain.from_iterable(
+            partition.read(start, end) for key, partition in partitions
+            if key != UNTIMED and overlaps(key, start_at, end_at))
+
+    def _find_partitions(self):
+        if not isdir(self._path):
+            return
+        for file_name in os.listdir(self._path):
+            key, extension = os.path.splitext(file_name)
+            if extension == DATA_EXTENSION and key not in self._partitions:
+                self._partitions[key] = Partition(join(self._path, key))
+
+
+class Partition(object):
+    """An append-only file of BSON documents and its _timestamp index
+
+    The size of the data and the index held in memory are caught up with
+    the files before each read, under a shared lock on the data file.
+    Appends hold an exclusive lock and write at the real end of the file.
+    """
+    INDEX_ENTRY = struct.Struct("<qq")
+
+    def __init__(self, path):
+        self._data_path = path + DATA_EXTENSION
+        self._index_path = path + INDEX_EXTENSION
+        self._lock = threading.Lock()
+        self._size = 0
+        self._index_size = 0
+        self._times, self._offsets = [], []
+
+    def _refresh(self):
+        """Load what has been appended since the last refresh"""
+        if not isfile(self._data_path):
+            return
+        with open(self._data_path, "rb") as f:
+            with locked(f, fcntl.LOCK_SH):
+                size = os.fstat(f.fileno()).st_size
+                index = ""
+                if isfile(self._index_path):
+                    with open(self._index_path, "rb") as index_file:
+                        index_file.seek(self._index_size)
+                        index = index_file.read()
+
+        entry_size = self.INDEX_ENTRY.size
+        length = len(index) - len(index) % entry_size
+        # Entries past the end of the data were never fully written
+        entries = sorted(entry for entry in (
+            self.INDEX_ENTRY.unpack_from(index, position)
+            for position in xrange(0, length, entry_size))
+            if entry[1] < size)
+        if entries and self._times and entries[0][0] < self._times[-1]:
+            entries = sorted(chain(zip(self._times, self._offsets), entries))
+            self._times, self._offsets = [], []
+        self._times.extend(time for time, _ in entries)
+        self._offsets.extend(offset for _, offset in entries)
+        self._index_size += length
+        self._size = size
+
+    def append(self, documents):
+        """Append (encoded document, timestamp in microseconds) pairs"""
+        with self._lock:
+            with open(self._data_path, "ab") as f:
+                with locked(f, fcntl.LOCK_EX):
+                    offset = os.fstat(f.fileno()).st_size
+                    entries = []
+                    for document, timestamp in documents:
+                        f.write(document)
+                        if timestamp is not None:
+                            entries.append((timestamp, offset))
+                        offset += len(document)
+                    f.flush()
+                    if entries:
+                        with open(self._index_path, "ab") as index_file:
+                            index_file.write("".join(
+                                self.INDEX_ENTRY.pack(*entry)
+                                for entry in entries))
+
+    def read(self, start=None, end=None):
+        """Yield the records with a timestamp in [start, end) microseconds
+
+        With no range every record is read.
+        """
+        with self._lock:
+            self._refresh()
+            size = self._size
+            if start is None and end is None:
+                offsets = None
+            else:
+                low = bisect_left(self._times, start) \
+                    if start is not None else 0
+                high = bisect_left(self._times, end) \
+                    if end is not None else len(self._times)
+                offsets = sorted(self._offsets[low:high])
+
+        if not size or offsets == []:
+            return
+
+        # Records are decoded as they are read, not all at once
+        with open(self._data_path, "rb") as f:
+            with closing(mmap.mmap(f.fileno(), size,
+                                   access=mmap.ACCESS_READ)) as data:
+                if offsets is None:
+                    records = decode_all_lazily(data, size)
+                else:
+                    records = (decode_at(data, offset) for offset in offsets)
+                for record in records:
+                    yield record
+
+
+def make_dirs(path):
+    """Create a directory and its parents unless it exists"""
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+@contextmanager
+def locked(f, operation):
+    """Hold an flock on an open file"""
+    fcntl.flock(f.fileno(), operation)
+    try:
+        yield f
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def decode_all_lazily(data, size, batch_size=DECODE_BATCH):
+    """Decode the documents in a buffer a batch at a time
+
+    >>> data = "".join(bson.BSON.encode({"a": a}) for a in range(5))
+    >>> list(decode_all_lazily(data, len(data), 2))
+    [{u'a': 0}, {u'a': 1}, {u'a': 2}, {u'a': 3}, {u'a': 4}]
+    """
+    start = 0
+    while start < size:
+        end, count = start, 0
+        while end < size and count < batch_size:
+            end += struct.unpack_from("<i", data, end)[0]
+            count += 1
+        for record in bson.decode_all(data[start:end]):
+            yield record
+        start = end
+
+
+def decode_at(data, offset):
+    length = struct.unpack_from("<i", data, offset)[0]
+    return bson.BSON(data[offset:offset + length]).decode()
+
+
+def to_micros(dt):
+    """
+    >>> from datetime import datetime
+    >>> to_micros(datetime(1970, 1, 1, 0, 0, 1, 5))
+    1000005
+    """
+    dt = as_utc(dt)
+    return calendar.timegm(dt.utctimetuple()) * 1000000 + dt.microsecond
+
+
+def partition_key(timestamp):
+    """The partition a record belongs in and its timestamp in microseconds
+
+    >>> from datetime import datetime
+    >>> partition_key(datetime(2012, 12, 12))
+    ('2012-12', 1355270400000000)
+    >>> partition_key(None)
+    ('untimed', None)
+    """
+    key = month_key(timestamp)
+    if key is None:
+        return UNTIMED, None
+    return key, to_micros(timestamp)
+
+
+QueryPlan = namedtuple("QueryPlan", [
+    "query", "filter_by", "start_at", "end_at", "group_keys", "sort",
+    "limit", "fields", "after"])
+
+
+def plan_query(query):
+    """
+    >>> from backdrop.timeutils import WEEK
+    >>> plan = plan_query({"group_by": "foo", "period": WEEK,
+    ...                    "filter_by": {"bar": 1}})
+    >>> plan.filter_by, plan.group_keys
+    ((('bar', 1),), ('foo', '_week_start_at'))
+    """
+    group_keys = []
+    if query.get("group_by"):
+        group_keys.append(query["group_by"])
+    if query.get("period"):
+        group_keys.append(query["period"].start_at_key)
+
+    sort_by = query.get("sort_by")
+    sort = (sort_by["field"], sort_by["direction"] == "descending") \
+        if sort_by else None
+
+    limit, fields, after = query.get("limit", 0), query.get("fields", ()), None
+    if "page_size" in query:
+        # Pages are read like MongoData reads them, see get_mongo_spec
+        sort = (page_sort_field(query), bool(sort and sort[1]))
+        limit = query["page_size"] + 1
+        if fields:
+            fields = list(fields) + [sort[0], "_id"]
+        if "page_token" in query:
+            after = after_page_token(query["page_token"], sort[1])
+
+    return QueryPlan(
+        query,
+        tuple(sorted(query.get("filter_by", {}).items())),
+        query.get("start_at"),
+        query.get("end_at"),
+        tuple(group_keys),
+        sort,
+        limit,
+        tuple(fields),
+        after)
+
+
+def after_page_token(token, descending):
+    """Return a function matching records that sort after a page token
+
+    >>> from backdrop.query import PageToken
+    >>> after = after_page_token(PageToken("a", 1, 2), False)
+    >>> after({"a": 1, "_id": 3}), after({"a": 1, "_id": 1}), after({"_id": 3})
+    (True, False, False)
+    """
+    field, value, _id = token
+    def after(record):
+        key = (record.get(field), record["_id"])
+        return key < (value, _id) if descending else key > (value, _id)
+    return after
+
+
+def partial_match(filter_by):
+    """
+    >>> partial_match((("a", 1),))({"a": 1, "b": 2})
+    True
+    >>> partial_match((("a", 1),))({"b": 2})
+    False
+    """
+    def matches(record):
+        for field, value in filter_by:
+            if record.get(field) != value:
+                return False
+        return True
+    return matches
+
+
+def select_fields(fields, record):
+    """
+    >>> select_fields(("a",), {"_id": 1, "a": 2, "b": 3})
+    {'a': 2}
+    """
+    return dict((field, record[field]) for field in fields if field in record)
+
+
+def sort_records(records, plan):
+    """Sort and limit raw records as a Mongo find would
+
+    With a limit only that many records are held while sorting.
+    """
+    if plan.sort is None:
+        return islice(records, plan.limit or None)
+
+    field, descending = plan.sort
+    if "page_size" in plan.query:
+        # Records are ordered by _id within a sort value
+        sort_key = lambda record: (record.get(field), record["_id"])
+    else:
+        sort_key = lambda record: record.get(field)
+    if plan.limit:
+        smallest = heapq.nlargest if descending else heapq.nsmallest
+        return smallest(plan.limit, records, key=sort_key)
+    return sorted(records, key=sort_key, reverse=descending)
+
+
+def group_records(records, plan):
+    """Group records by the plan's keys, collecting the values to reduce
+
+    Records missing any key are left out, as MongoData does. Collected
+    fields hold the list of their values in the group.
+
+    >>> plan = plan_query({"group_by": "a", "collect": [["b", "sum"]]})
+    >>> [sorted(group.items()) for group in group_records(
+    ...     [{"a": 1, "b": 1}, {"a": 1, "b": 2}, {"b": 3}], plan)]
+    [[('_count', 2), ('a', 1), ('b', [1, 2])]]
+    """
+    keys = plan.group_keys
+    fields = sorted(set(field for field, _ in plan.query.get("collect", [])))
+    groups = {}
+    for record in records:
+        key = tuple(record.get(name) for name in keys)
+        if None in key:
+            continue
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = dict(zip(keys, key))
+            group["_count"] = 0
+            for field in fields:
+                group[field] = []
+        group["_count"] += 1
+        for field in fields:
+            group[field].append(record.get(field))
+
+    results = sort_groups(groups.values(), keys, plan.query.get("sort_by"))
+
+    return results[:plan.limit] if plan.limit else results
@@ -1,115 +1,476 @@
 import datetime
-
-from pymongo import Connection
+import heapq
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from functools import partial
+from itertools import chain, imap, islice
+
+from pymongo.errors import BulkWriteError, CollectionInvalid
 import pymongo
-from bson import Code
+from bson.son import SON
 
-from .base import Data
-from ..timeutils import as_utc
+from .base import Data, batches, batches_of, convert_datetimes_to_utc, \
+    sort_groups
+from .indexes import plan_schema_indexes, plan_workload_indexes, \
+    missing_indexes
+from .rollups import parse_rollups, rollup_increments, can_use_rollup, \
+    rollup_spec, rollup_sort, rollup_result, BUCKET_INDEX
+from .connections import connect, parse_write_concern
+from .partitions import parse_partitions, month_key, keys_in_range, \
+    keys_between, oldest_kept, expired_keys, partition_name, partition_keys
+from ..query import collect_key, page_sort_field
+from ..timeutils import PERIOD_START_KEYS
 
 
 __all__ = ["MongoData"]
 
 
+DEFAULT_BATCH_SIZE = 1000
+
+# Seconds the known collections are trusted before they are listed again
+COLLECTIONS_TTL = 60
+
+
 def collection_name_from_id(data_set_id):
     """Calculate the Mongo collection name from the data set id"""
     return data_set_id
 
 
-class MongoData(Data):
-    def __init__(self, host, database):
-        self._mongo = Connection(host)
-        self._db = self._mongo[database]
+def rollup_collection_name(data_set_id):
+    """
+    >>> rollup_collection_name("foo")
+    'foo.rollups'
+    """
+    return "{}.rollups".format(collection_name_from_id(data_set_id))
 
 
-    def exists(self, data_set_id):
-        collection_name = collection_name_from_id(data_set_id)
-        return collection_name in self._db.collection_names()
+class MongoData(Data):
+    def __init__(self, host, database, batch_size=DEFAULT_BATCH_SIZE,
+                 config=None):
+        self._database = database
+        self._batch_size = batch_size
+        self._indexed_rollups = set()
+        self._collections = None
+        self._collections_listed_at = None
+        self._collections_lock = threading.Lock()
+        self.connect(host, config)
 
 
-    def create(self, data_set_id, capped, size, schema):
-        # Create collection
-        if capped:
-            self._db.create_collection(data_set_id, capped=capped, size=size)
-        else:
-            self._db.create_collection(data_set_id)
+    def connect(self, host, config=None):
+        """Connect to a host or replica set seed list with a ConnectionConfig
 
-        # Create indexes for fields that are defined and required
-        # TODO: Figure out how to calculate meta fields that need indexing, ie. period start fields
-        required = schema.get("required", [])
-        for field_name, field_meta in schema.get("properties", {}).items():
-            if field_name in required:
-                self._db[data_set_id].create_index(field_name)
+        Queries use a separate client if the config has a read preference
+        other than primary. Connecting again replaces the clients.
+        """
+        self._mongo, self._read_mongo = connect(host, config)
+        self._db = self._mongo[self._database]
+        self._read_db = self._read_mongo[self._database]
 
 
-    def save(self, data_set_id, records):
-        for record in records:
-            self._db[data_set_id].save(record)
+    def exists(self, data_set_id):
+        """Check for the collection in a process local set of known names
 
+        The set is kept up to date by create and listed from Mongo again
+        every COLLECTIONS_TTL seconds, so collections dropped by another
+        process are noticed.
+        """
+        collection_name = collection_name_from_id(data_set_id)
+        return collection_name in self._known_collections()
 
-    def query(self, data_set_id, query):
-        return map(convert_datetimes_to_utc,
-                self._execute_query(data_set_id, query))
 
+    def create(self, data_set_id, capped, size, schema):
+        """Create the collection unless it is already known to exist
 
-    def _execute_query(self, data_set_id, query):
-        """Execute the correct type of query; group or raw"""
-        if is_group_query(query):
-            return list(self._group_query(data_set_id, query))
+        Concurrent creates in this process are serialised. If another
+        process got there first the known collections are refreshed.
+        """
+        collection_name = collection_name_from_id(data_set_id)
+        with self._collections_lock:
+            collections = self._known_collections()
+            if collection_name in collections:
+                return
+            try:
+                self._create_collection(collection_name, capped, size, schema)
+            except CollectionInvalid:
+                self._collections = None
+            else:
+                self._collections = collections | frozenset([collection_name])
+
+
+    def _create_collection(self, collection_name, capped, size, schema):
+        # Create collection
+        if capped:
+            self._db.create_collection(collection_name, capped=capped, size=size)
         else:
-            return list(self._raw_query(data_set_id, query))
-
-
-    def _group_query(self, data_set_id, query):
-        keys = get_group_keys(query)
-        spec = get_mongo_spec(query)
-        collect_fields = get_unique_collect_fields(query)
-
-        return self._db[data_set_id].group(
-            key = keys,
-            condition = build_group_condition(keys, spec),
-            initial = build_group_initial_state(collect_fields),
-            reduce = Code(build_group_reducer(collect_fields)))
-
+            self._db.create_collection(collection_name)
+
+        # Create indexes for required fields, _timestamp and period starts
+        for index in plan_schema_indexes(schema):
+            self._db[collection_name].create_index(index)
+
+
+    def missing_indexes(self, data_set_id, schema, queries=()):
+        """List the indexes the schema and a query workload need but the
+        collection does not have
+        """
+        planned = plan_schema_indexes(schema) + plan_workload_indexes(queries)
+        collection = self._db[collection_name_from_id(data_set_id)]
+
+        return missing_indexes(planned, collection.index_information())
+
+
+    def create_indexes(self, data_set_id, indexes):
+        collection = self._db[collection_name_from_id(data_set_id)]
+        for index in indexes:
+            collection.create_index(index)
+
+
+    def refresh_collections(self):
+        """Forget the known collections, eg. after dropping one"""
+        self._collections = None
+
+
+    def _known_collections(self):
+        """The known collection names, a snapshot that is never mutated
+
+        Changes replace the set, under the lock, so it can be iterated
+        while other threads create or drop collections.
+        """
+        collections, listed_at = self._collections, self._collections_listed_at
+        now = time.time()
+        if collections is None or now - listed_at >= COLLECTIONS_TTL:
+            collections = frozenset(self._db.collection_names())
+            self._collections, self._collections_listed_at = collections, now
+        return collections
+
+
+    def save(self, data_set_id, records, data_set=None):
+        """Insert records in batches with one unordered insert per batch
+
+        A record that fails to insert does not stop the rest of its batch.
+        Returns the number of records saved and the indexes of the records
+        that failed. Rollups configured for the data set are updated with
+        the records that were saved. Partitioned data sets have each batch
+        split between the partitions its records belong in.
+        """
+        collection = self._db[data_set_id]
+        rollups = parse_rollups(data_set)
+        partitions = parse_partitions(data_set)
+        write_concern = parse_write_concern(data_set)
+        saved, failed = 0, []
+        for offset, batch in batches(records, self._batch_size):
+            if partitions is None:
+                inserted, failed_in_batch = insert_batch(
+                    collection, batch, write_concern)
+            else:
+                inserted, failed_in_batch = self._insert_partitioned(
+                    data_set_id, batch, data_set, partitions, write_concern)
+            saved += inserted
+            failed.extend(offset + index for index in failed_in_batch)
+            if rollups:
+                self._update_rollups(data_set_id, rollups,
+                        without_indexes(batch, failed_in_batch),
+                        write_concern)
+        return saved, failed
+
+
+    def _insert_partitioned(self, data_set_id, batch, data_set, partitions,
+                            write_concern=None):
+        """Insert a batch into the partitions for its records' _timestamps
+
+        Records for months retention has already dropped are not saved.
+        Records without a _timestamp go in the data set's own collection.
+        """
+        name = collection_name_from_id(data_set_id)
+        oldest = oldest_kept(partitions.retention, datetime.datetime.utcnow())
+
+        failed, by_partition = [], OrderedDict()
+        for index, record in enumerate(batch):
+            key = month_key(record.get("_timestamp"))
+            if key is not None and oldest is not None and key < oldest:
+                failed.append(index)
+            else:
+                by_partition.setdefault(key, []).append(index)
+
+        inserted = 0
+        for key, indexes in by_partition.items():
+            if key is None:
+                collection_name = name
+            else:
+                collection_name = partition_name(name, key)
+                self._create_partition(data_set_id, collection_name,
+                                       data_set, partitions)
+            saved_here, failed_here = insert_batch(
+                self._db[collection_name], [batch[i] for i in indexes],
+                write_concern)
+            inserted += saved_here
+            failed.extend(indexes[i] for i in failed_here)
+
+        return inserted, sorted(failed)
+
+
+    def _create_partition(self, data_set_id, collection_name, data_set,
+                          partitions):
+        """Create a partition with the data set's indexes if it is new
+
+        Creating a partition is when expired partitions are dropped.
+        """
+        if collection_name in self._known_collections():
+            return
+        with self._collections_lock:
+            collections = self._known_collections()
+            if collection_name in collections:
+                return
+            try:
+                self._create_collection(collection_name, False, 0,
+                                        data_set.get("schema", {}))
+            except CollectionInvalid:
+                self._collections = None
+            else:
+                self._collections = collections | frozenset([collection_name])
+        self.drop_expired_partitions(data_set_id, partitions.retention)
+
+
+    def drop_expired_partitions(self, data_set_id, retention, now=None):
+        """Drop the whole partitions that retention no longer keeps"""
+        name = collection_name_from_id(data_set_id)
+        keys = partition_keys(name, self._db.collection_names())
+        for key in expired_keys(keys, retention,
+                                now or datetime.datetime.utcnow()):
+            self._db.drop_collection(partition_name(name, key))
+            with self._collections_lock:
+                if self._collections is not None:
+                    self._collections = self._collections - frozenset(
+                        [partition_name(name, key)])
+
+
+    def _update_rollups(self, data_set_id, rollups, records,
+                        write_concern=None):
+        increments = rollup_increments(records, rollups)
+        if not increments:
+            return
+
+        collection = self._rollup_collection(data_set_id)
+        bulk = collection.initialize_unordered_bulk_op()
+        for key, update in increments:
+            bulk.find(key).upsert().update_one(update)
+        bulk.execute(write_concern=write_concern)
+
+
+    def rebuild_rollups(self, data_set_id, data_set):
+        """Build a data set's rollup buckets from the records it holds
+
+        Existing buckets are dropped first, so nothing should write to the
+        data set while they are rebuilt. Returns the records rolled up.
+        """
+        self._db.drop_collection(rollup_collection_name(data_set_id))
+        self._indexed_rollups.discard(data_set_id)
+        rollups = parse_rollups(data_set)
+        if rollups is None:
+            return 0
+
+        collection_names = self._collections_to_query(
+            data_set_id, {}, parse_partitions(data_set))
+        records = chain.from_iterable(
+            self._db[collection_name].find().batch_size(self._batch_size)
+            for collection_name in collection_names)
+        count = 0
+        for _, batch in batches(records, self._batch_size):
+            self._update_rollups(data_set_id, rollups, batch)
+            count += len(batch)
+        return count
+
+
+    def _rollup_collection(self, data_set_id):
+        collection = self._db[rollup_collection_name(data_set_id)]
+        if data_set_id not in self._indexed_rollups:
+            collection.create_index(BUCKET_INDEX, unique=True)
+            self._indexed_rollups.add(data_set_id)
+        return collection
+
+
+    def plan(self, query):
+        return plan_query(query)
+
+
+    def query(self, data_set_id, query, data_set=None, plan=None):
+        """Return an iterator over batches of results, read lazily from Mongo
+        """
+        results = self._execute_query(data_set_id, plan or plan_query(query),
+                                      parse_rollups(data_set),
+                                      parse_partitions(data_set))
+
+        return imap(convert_datetimes_to_utc,
+                    batches_of(results, self._batch_size))
+
+
+    def _execute_query(self, data_set_id, plan, rollups=None,
+                       partitions=None):
+        """Execute the correct type of query; rollup, group or raw"""
+        if can_use_rollup(plan.query, rollups):
+            return self._rollup_query(data_set_id, plan)
+
+        collection_names = self._collections_to_query(
+            data_set_id, plan.query, partitions)
+        if plan.pipeline is not None:
+            if len(collection_names) == 1:
+                return self._group_query(collection_names[0], plan)
+            return self._partitioned_group_query(collection_names, plan)
+        else:
+            return self._raw_query(collection_names, plan)
+
+
+    def _collections_to_query(self, data_set_id, query, partitions):
+        """The collections that hold the records a query could match
+
+        For partitioned data sets that is the partitions overlapping the
+        query's time range, and the collection of records without a
+        _timestamp if there is no time range. Partitions are found from the
+        known collections, along with those for the months since they were
+        listed, which another process may have created. A partition that
+        does not exist reads as empty.
+        """
+        name = collection_name_from_id(data_set_id)
+        if partitions is None:
+            return [name]
+
+        start_at, end_at = query.get("start_at"), query.get("end_at")
+        keys = set(partition_keys(name, self._known_collections()))
+        keys.update(keys_between(
+            datetime.datetime.utcfromtimestamp(self._collections_listed_at),
+            datetime.datetime.utcnow()))
+        keys = keys_in_range(keys, start_at, end_at)
+        names = [partition_name(name, key) for key in keys]
+        if start_at is None and end_at is None:
+            names.insert(0, name)
+        return names
+
+
+    def _group_query(self, collection_name, plan):
+        """Group and collect with the aggregation framework
+
+        Grouping and the collect functions are computed by Mongo so only
+        one document per group comes back. Large groupings may spill to
+        disk rather than fail.
+        """
+        cursor = self._read_db[collection_name].aggregate(
+            plan.pipeline, allowDiskUse=True, cursor={})
+
+        return imap(flatten_group_result, cursor)
+
+
+    def _partitioned_group_query(self, collection_names, plan):
+        """Group each partition in Mongo then merge the groups
+
+        Groups such as weeks can span partitions, so each partition returns
+        partial collected values which are combined here, then the merged
+        groups are sorted and limited.
+        """
+        pipeline = build_partial_group_pipeline(plan.query)
+        cursors = [self._read_db[collection_name].aggregate(
+                       pipeline, allowDiskUse=True, cursor={})
+                   for collection_name in collection_names]
+        groups = merge_partial_groups(
+            imap(flatten_group_result, chain.from_iterable(cursors)),
+            plan.group_keys, plan.query.get("collect", []))
+
+        groups = sort_groups(groups, plan.group_keys,
+                             plan.query.get("sort_by"))
+        return groups[:plan.limit] if plan.limit else groups
+
+
+    def _rollup_query(self, data_set_id, plan):
+        self._rollup_collection(data_set_id)
+        cursor = self._read_db[rollup_collection_name(data_set_id)].find(
+            rollup_spec(plan.query),
+            sort=rollup_sort(plan.query),
+            limit=plan.limit)
+
+        return imap(partial(rollup_result, query=plan.query), cursor)
+
+
+    def _raw_query(self, collection_names, plan):
+        """Find records, merging sorted results across partitions
+
+        Only the planned fields are read, a batch of results at a time.
+        """
+        merge_sort = plan.sort if len(collection_names) > 1 else None
+        projection = with_merge_fields(plan.projection, merge_sort)
+        cursors = [self._read_db[collection_name]
+                   .find(plan.spec, projection, sort=plan.sort,
+                         limit=plan.limit)
+                   .batch_size(self._batch_size)
+                   for collection_name in collection_names]
+        if len(cursors) == 1:
+            return cursors[0]
+
+        if merge_sort:
+            results = merge_sorted(cursors, merge_sort)
+            if projection is not plan.projection:
+                results = imap(partial(without_fields, [
+                    field for field in projection
+                    if field not in plan.projection]), results)
+        else:
+            results = chain.from_iterable(cursors)
+        return islice(results, plan.limit or None)
 
-    def _raw_query(self, data_set_id, query):
-        spec = get_mongo_spec(query)
-        sort = get_mongo_sort(query)
-        limit = get_mongo_limit(query)
 
-        return self._db[data_set_id].find(spec, sort=sort, limit=limit)
+QueryPlan = namedtuple("QueryPlan", [
+    "query", "spec", "sort", "limit", "group_keys", "pipeline", "projection"])
 
 
-def convert_datetimes_to_utc(result):
-    """Convert datatime values in a result to UTC
+def plan_query(query):
+    """Build everything needed to run a parsed query against Mongo
 
-    MongoDB ignores offsets, we don't.
+    Group queries get an aggregation pipeline, others a find spec.
 
-    >>> convert_datetimes_to_utc({})
-    {}
-    >>> convert_datetimes_to_utc({'foo': 'bar'})
-    {'foo': 'bar'}
-    >>> convert_datetimes_to_utc({'foo': datetime.datetime(2012, 12, 12)})
-    {'foo': datetime.datetime(2012, 12, 12, 0, 0, tzinfo=<UTC>)}
+    >>> plan = plan_query({"group_by": "foo", "limit": 5})
+    >>> plan.spec, plan.sort, plan.limit, plan.group_keys
+    ({}, None, 5, ('foo',))
+    >>> [stage.keys()[0] for stage in plan.pipeline]
+    ['$match', '$group', '$sort', '$limit']
+    >>> plan_query({}).pipeline
     """
-    def time_as_utc(value):
-        if isinstance(value, datetime.datetime):
-            return as_utc(value)
-        return value
-
-    return dict((key, time_as_utc(value)) for key, value in result.items())
-
-
-def is_group_query(query):
+    group_keys = tuple(get_group_keys(query))
+    return QueryPlan(
+        query,
+        get_mongo_spec(query),
+        get_mongo_sort(query),
+        get_mongo_limit(query),
+        group_keys,
+        build_group_pipeline(query) if group_keys else None,
+        None if group_keys else get_mongo_projection(query))
+
+
+def insert_batch(collection, records, write_concern=None):
+    """Insert records with a single unordered bulk insert
+
+    Returns the number inserted and the indexes of records that failed.
+    Unacknowledged inserts, with a write concern of w=0, are all counted
+    as inserted.
     """
-    >>> is_group_query({"group_by": "foo"})
-    True
-    >>> is_group_query({"period": "week"})
-    True
-    >>> is_group_query({"foo": "bar"})
-    False
+    bulk = collection.initialize_unordered_bulk_op()
+    for record in records:
+        bulk.insert(record)
+    try:
+        result = bulk.execute(write_concern=write_concern)
+    except BulkWriteError as e:
+        result = e.details
+    if result is None:
+        return len(records), []
+    return (result['nInserted'],
+            sorted(error['index'] for error in result['writeErrors']))
+
+
+def without_indexes(records, indexes):
+    """
+    >>> without_indexes(["a", "b", "c"], [1])
+    ['a', 'c']
     """
-    return bool(query.get("group_by") or query.get("period"))
+    indexes = set(indexes)
+    return [record for index, record in enumerate(records)
+            if index not in indexes]
 
 
 def get_mongo_limit(query):
@@ -118,20 +479,58 @@ def get_mongo_limit(query):
     0
     >>> get_mongo_limit({"limit": 100})
     100
+    >>> get_mongo_limit({"page_size": 100})
+    101
     """
+    if "page_size" in query:
+        # One more than a page tells whether there is a next page
+        return query["page_size"] + 1
     return query.get("limit", 0)
 
 
+def get_mongo_projection(query):
+    """The fields raw records are read with
+
+    Only the fields asked for, or every field but the period start meta
+    fields which results never include. Pages also need their sort field
+    and _id for the next page's token.
+
+    >>> sorted(get_mongo_projection({"fields": ["foo"]}).items())
+    [('_id', 0), ('foo', 1)]
+    >>> sorted(get_mongo_projection({"fields": ["foo"], "page_size": 1}))
+    ['_id', 'foo']
+    >>> sorted(get_mongo_projection({}))[:2]
+    ['_day_start_at', '_hour_start_at']
+    """
+    if query.get("fields"):
+        projection = dict((field, 1) for field in query["fields"])
+        if "page_size" in query:
+            projection[page_sort_field(query)] = 1
+            projection["_id"] = 1
+        projection.setdefault("_id", 0)
+        return projection
+    return dict((key, 0) for key in PERIOD_START_KEYS)
+
+
 # TODO: make sort spec less shit
 def get_mongo_sort(query):
     """
     >>> get_mongo_sort({})
     >>> get_mongo_sort({"sort_by": {"field": "foo", "direction": "ascending"}})
     [('foo', 1)]
+    >>> get_mongo_sort({"page_size": 10})
+    [('_id', 1)]
     """
+    sort = []
     if query.get("sort_by"):
         direction = get_mongo_sort_direction(query["sort_by"]["direction"])
-        return [(query["sort_by"]["field"], direction)]
+        sort.append((query["sort_by"]["field"], direction))
+    if "page_size" in query and page_sort_field(query) != "_id":
+        # Pages are ordered by _id within a sort value
+        sort.append(("_id", sort[0][1]))
+    elif "page_size" in query:
+        sort.append(("_id", pymongo.ASCENDING))
+    return sort or None
 
 
 def get_mongo_sort_direction(direction):
@@ -151,8 +550,41 @@ def get_mongo_sort_direction(direction):
 def get_mongo_spec(query):
     filter_by = query.get("filter_by", {})
     time_range = time_range_to_mongo_query(query.get("start_at"), query.get("end_at"))
+    spec = dict(filter_by.items() + time_range.items())
+
+    if "page_token" in query:
+        after = after_page_token(query["page_token"],
+                                 query.get("sort_by", {}).get("direction"))
+        spec = {"$and": [spec, after]} if spec else after
+    return spec
+
 
-    return dict(filter_by.items() + time_range.items())
+def after_page_token(token, direction=None):
+    """Match the records that sort after a page token
+
+    Records are ordered by the token's field then _id, and records without
+    the field sort before any that have it, as they do in Mongo.
+
+    >>> from backdrop.query import PageToken
+    >>> after_page_token(PageToken("_id", 5, 5))
+    {'_id': {'$gt': 5}}
+    >>> [sorted(clause.items()) for clause in after_page_token(
+    ...     PageToken("foo", "bar", 5), "descending")["$or"]]
+    [[('foo', {'$lt': 'bar'})], [('_id', {'$lt': 5}), ('foo', 'bar')], [('foo', None)]]
+    """
+    field, value, _id = token
+    later = "$lt" if direction == "descending" else "$gt"
+    if field == "_id":
+        return {"_id": {later: _id}}
+
+    same_value = {field: value, "_id": {later: _id}}
+    if direction == "descending":
+        if value is None:
+            return same_value
+        return {"$or": [{field: {"$lt": value}}, same_value, {field: None}]}
+    if value is None:
+        return {"$or": [{field: {"$ne": None}}, same_value]}
+    return {"$or": [{field: {"$gt": value}}, same_value]}
 
 
 def time_range_to_mongo_query(start_at, end_at):
@@ -177,14 +609,6 @@ def time_range_to_mongo_query(start_at, end_at):
     return mongo
 
 
-def get_unique_collect_fields(query):
-    """
-    >>> get_unique_collect_fields({"collect":[["foo", "sum"]]})
-    ['foo']
-    """
-    return list(set([field for field, _ in query.get("collect", [])]))
-
-
 def get_group_keys(query):
     """
     >>> from backdrop.timeutils import WEEK
@@ -214,38 +638,231 @@ def build_group_condition(keys, spec):
     return dict(spec.items() + key_filter)
 
 
-def build_group_initial_state(collect_fields):
+COLLECT_ACCUMULATORS = {
+    "sum": lambda field: {"$sum": field},
+    "count": lambda field: {"$sum": {
+        "$cond": [{"$eq": [{"$ifNull": [field, None]}, None]}, 0, 1]}},
+    "set": lambda field: {"$addToSet": field},
+    "mean": lambda field: {"$avg": field},
+}
+# Partial means from partitions, merged into a mean afterwards
+COLLECT_ACCUMULATORS["mean:sum"] = COLLECT_ACCUMULATORS["sum"]
+COLLECT_ACCUMULATORS["mean:count"] = COLLECT_ACCUMULATORS["count"]
+
+
+def build_group_pipeline(query):
+    """Build an aggregation pipeline that groups and collects server side
+
+    >>> pipeline = build_group_pipeline(
+    ...     {"group_by": "foo", "collect": [["bar", "sum"]], "limit": 5})
+    >>> [stage.keys()[0] for stage in pipeline]
+    ['$match', '$group', '$sort', '$limit']
+    >>> pipeline[1]['$group']['bar:sum']
+    {'$sum': '$bar'}
+    """
+    keys = get_group_keys(query)
+    spec = get_mongo_spec(query)
+
+    pipeline = [
+        {"$match": build_group_condition(keys, spec)},
+        {"$group": build_group_stage(keys, query.get("collect", []))},
+        {"$sort": build_group_sort(keys, query)},
+    ]
+    limit = get_mongo_limit(query)
+    if limit:
+        pipeline.append({"$limit": limit})
+
+    return pipeline
+
+
+def build_partial_group_pipeline(query):
+    """Build a pipeline that groups one partition of a data set
+
+    Means are returned as a partial sum and count to be merged with
+    merge_partial_groups. Groups are not sorted or limited.
+
+    >>> pipeline = build_partial_group_pipeline(
+    ...     {"group_by": "foo", "collect": [["bar", "mean"]], "limit": 5})
+    >>> [stage.keys()[0] for stage in pipeline]
+    ['$match', '$group']
+    >>> sorted(pipeline[1]['$group'])
+    ['_count', '_id', 'bar:mean:count', 'bar:mean:sum']
+    """
+    keys = get_group_keys(query)
+    collect = []
+    for field, function in query.get("collect", []):
+        if function == "mean":
+            collect.extend([[field, "mean:sum"], [field, "mean:count"]])
+        else:
+            collect.append([field, function])
+
+    return [
+        {"$match": build_group_condition(keys, get_mongo_spec(query))},
+        {"$group": build_group_stage(keys, collect)},
+    ]
+
+
+def merge_partial_groups(results, keys, collect):
+    """Merge groups from partitions that have the same keys
+
+    >>> results = [
+    ...     {"foo": "a", "_count": 1, "bar:set": [1], "bar:mean:sum": 1,
+    ...      "bar:mean:count": 1},
+    ...     {"foo": "a", "_count": 2, "bar:set": [1, 2], "bar:mean:sum": 5,
+    ...      "bar:mean:count": 2}]
+    >>> [sorted(group.items()) for group in merge_partial_groups(
+    ...     results, ["foo"], [["bar", "set"], ["bar", "mean"]])]
+    [[('_count', 3), ('bar:mean', 2.0), ('bar:set', [1, 2]), ('foo', 'a')]]
     """
-    >>> build_group_initial_state([])
-    {'_count': 0}
-    >>> build_group_initial_state(["foo"])
-    {'_count': 0, 'foo': []}
+    groups = OrderedDict()
+    for result in results:
+        key = tuple(result[name] for name in keys)
+        group = groups.get(key)
+        if group is None:
+            groups[key] = result
+            continue
+
+        group["_count"] += result["_count"]
+        for field, function in collect:
+            if function == "set":
+                name = collect_key(field, "set")
+                group[name] = group[name] + [value for value in result[name]
+                                             if value not in group[name]]
+            elif function == "mean":
+                for part in ["mean:sum", "mean:count"]:
+                    group[collect_key(field, part)] += \
+                        result[collect_key(field, part)]
+            else:
+                name = collect_key(field, function)
+                group[name] += result[name]
+
+    for group in groups.values():
+        for field, function in collect:
+            if function == "mean":
+                total = group.pop(collect_key(field, "mean:sum"))
+                count = group.pop(collect_key(field, "mean:count"))
+                group[collect_key(field, "mean")] = \
+                    float(total) / count if count else None
+
+    return groups.values()
+
+
+def with_merge_fields(projection, sort):
+    """Add the fields results are merged by to a projection of some fields
+
+    >>> sorted(with_merge_fields({"_id": 0, "foo": 1}, [("bar", 1)]).items())
+    [('_id', 0), ('bar', 1), ('foo', 1)]
+    >>> projection = {"_day_start_at": 0}
+    >>> with_merge_fields(projection, [("bar", 1)]) is projection
+    True
     """
-    initial = {'_count': 0}
-    for field in  collect_fields:
-        initial[field] = []
-    return initial
+    includes_fields = projection and 1 in projection.values()
+    missing = [field for field, _ in sort or []
+               if projection and projection.get(field) != 1]
+    if not includes_fields or not missing:
+        return projection
+    projection = dict(projection)
+    for field in missing:
+        projection[field] = 1
+    return projection
+
+
+def without_fields(fields, result):
+    for field in fields:
+        result.pop(field, None)
+    return result
+
+
+class Descending(object):
+    """Reverses the order of a value in a sort key"""
+    __slots__ = ("value",)
 
+    def __init__(self, value):
+        self.value = value
 
-def build_group_reducer(collect_fields):
-    template = "function (current, previous)" \
-               "{{ previous._count++; {collectors} }}"
-    return template.format(
-            collectors=map(_build_collector_code, collect_fields))
+    def __eq__(self, other):
+        return self.value == other.value
 
+    def __lt__(self, other):
+        return other.value < self.value
 
-def _build_collector_code(collect_field):
-    template = "if (current['{c}'] !== undefined) " \
-               "{{ previous['{c}'].push(current['{c}']); }}"
-    return template.format(c=clean_collect_field(collect_field))
 
+def merge_sorted(iterables, sort):
+    """Merge iterables of results that are each in a Mongo sort order
 
-def clean_collect_field(collect_field):
+    >>> list(merge_sorted([[{"a": 1}, {"a": 3}], [{"a": 2}]], [("a", 1)]))
+    [{'a': 1}, {'a': 2}, {'a': 3}]
+    >>> [result["a"] for result in merge_sorted(
+    ...     [[{"a": 3}, {"a": 1}], [{"a": 2}]], [("a", -1)])]
+    [3, 2, 1]
     """
-    WTF python escaping!?
-    >>> clean_collect_field('foo\\\\bar')
-    'foo\\\\\\\\bar'
-    >>> clean_collect_field("foo'bar")
-    "foo\\\\\'bar"
+    def sort_key(result):
+        return tuple(Descending(result.get(field))
+                     if direction == pymongo.DESCENDING else result.get(field)
+                     for field, direction in sort)
+
+    heap = []
+    for position, iterator in enumerate(imap(iter, iterables)):
+        for result in iterator:
+            heap.append((sort_key(result), position, result, iterator))
+            break
+    heapq.heapify(heap)
+
+    while heap:
+        _, position, result, iterator = heap[0]
+        yield result
+        for result in iterator:
+            heapq.heapreplace(
+                heap, (sort_key(result), position, result, iterator))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+def build_group_stage(keys, collect):
+    """
+    >>> build_group_stage(["foo"], [])
+    {'_count': {'$sum': 1}, '_id': {'foo': '$foo'}}
+    >>> build_group_stage(["foo"], [["bar", "set"]])["bar:set"]
+    {'$addToSet': '$bar'}
+    """
+    group = {
+        "_id": dict((key, "$" + key) for key in keys),
+        "_count": {"$sum": 1},
+    }
+    for field, function in collect:
+        group[collect_key(field, function)] = \
+            COLLECT_ACCUMULATORS[function]("$" + field)
+    return group
+
+
+def build_group_sort(keys, query):
+    """Sort groups by their keys, starting with the sort_by field if given
+
+    >>> build_group_sort(["foo", "bar"], {})
+    SON([('_id.foo', 1), ('_id.bar', 1)])
+    >>> build_group_sort(["foo", "bar"],
+    ...     {"sort_by": {"field": "bar", "direction": "descending"}})
+    SON([('_id.bar', -1), ('_id.foo', 1)])
+    """
+    sort_by = query.get("sort_by")
+    if sort_by and sort_by["field"] in keys:
+        first = [(sort_by["field"],
+                  get_mongo_sort_direction(sort_by["direction"]))]
+    else:
+        first = []
+    rest = [(key, pymongo.ASCENDING) for key in keys
+            if key not in dict(first)]
+
+    return SON(("_id." + key, direction) for key, direction in first + rest)
+
+
+def flatten_group_result(result):
+    """Move the group keys out of _id and into the result
+
+    >>> flatten_group_result({"_id": {"foo": "bar"}, "_count": 1})
+    {'_count': 1, 'foo': 'bar'}
     """
-    return collect_field.replace('\\', '\\\\').replace("'", "\\'")
+    result = dict(result)
+    result.update(result.pop("_id"))
+    return result
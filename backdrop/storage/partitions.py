@@ -0,0 +1,163 @@
+"""
+Monthly time partitions for data sets with a _timestamp
+
+A data set opts in to partitions in its metadata, eg.
+
+    "partitions": {
+        "retention": 12
+    }
+
+Records are saved to a partition per month of their _timestamp and records
+without a _timestamp are kept apart. Queries with start_at or end_at only
+read the months they overlap. Retention drops whole months, keeping the
+current month and the months before it up to the given number. Without a
+retention every month is kept.
+
+Example:
+    partitions = parse_partitions(data_set)
+
+    # the partition a record is saved to
+    month_key(record["_timestamp"])
+
+    # the partitions a query reads
+    keys_in_range(keys, query.get("start_at"), query.get("end_at"))
+
+    # the partitions retention drops
+    expired_keys(keys, partitions.retention, now)
+"""
+import re
+from datetime import datetime
+
+from ..timeutils import MONTH, UTC, as_utc
+
+
+__all__ = [
+    'Partitions', 'parse_partitions', 'month_key', 'month_bounds',
+    'overlaps', 'keys_in_range', 'keys_between', 'oldest_kept',
+    'expired_keys', 'partition_name', 'partition_keys'
+]
+
+
+MONTH_KEY = re.compile(r"^\d{4}-\d{2}$")
+
+
+class Partitions(object):
+    def __init__(self, retention=None):
+        self.retention = retention
+
+
+def parse_partitions(data_set):
+    """Return the partitions configured for a data set, or None
+
+    >>> parse_partitions({}) is None
+    True
+    >>> parse_partitions({"partitions": {"retention": 12}}).retention
+    12
+    """
+    config = (data_set or {}).get("partitions")
+    if config is None:
+        return None
+    return Partitions(config.get("retention"))
+
+
+def month_key(timestamp):
+    """The partition for a timestamp, None if it is not a datetime
+
+    >>> month_key(datetime(2012, 12, 12))
+    '2012-12'
+    >>> month_key(None)
+    """
+    if not isinstance(timestamp, datetime):
+        return None
+    return as_utc(timestamp).strftime("%Y-%m")
+
+
+def month_bounds(key):
+    """The start and end of the month a partition holds
+
+    >>> month_bounds("2012-12")
+    (datetime.datetime(2012, 12, 1, 0, 0, tzinfo=tzutc()), datetime.datetime(2013, 1, 1, 0, 0, tzinfo=tzutc()))
+    """
+    year, month = key.split("-")
+    start = datetime(int(year), int(month), 1, tzinfo=UTC)
+    return start, start + MONTH.delta
+
+
+def overlaps(key, start_at, end_at):
+    """Check whether a partition overlaps the range [start_at, end_at)
+
+    >>> overlaps("2012-12", datetime(2012, 12, 20), None)
+    True
+    >>> overlaps("2012-12", None, datetime(2012, 12, 1))
+    False
+    """
+    start, end = month_bounds(key)
+    return (start_at is None or as_utc(start_at) < end) and \
+        (end_at is None or as_utc(end_at) > start)
+
+
+def keys_in_range(keys, start_at, end_at):
+    """
+    >>> keys_in_range(["2012-11", "2012-12"], datetime(2012, 12, 1), None)
+    ['2012-12']
+    """
+    return [key for key in sorted(keys) if overlaps(key, start_at, end_at)]
+
+
+def keys_between(start, end):
+    """The months from start's up to and including end's
+
+    >>> keys_between(datetime(2012, 11, 30), datetime(2013, 1, 1))
+    ['2012-11', '2012-12', '2013-01']
+    """
+    keys, key, last = [], month_key(start), month_key(end)
+    while key <= last:
+        keys.append(key)
+        key = month_key(month_bounds(key)[1])
+    return keys
+
+
+def oldest_kept(retention, now):
+    """The oldest partition retention keeps, None if it keeps them all
+
+    >>> oldest_kept(2, datetime(2012, 12, 12))
+    '2012-11'
+    """
+    if not retention:
+        return None
+    return month_key(MONTH.start(as_utc(now)) - MONTH.delta * (retention - 1))
+
+
+def expired_keys(keys, retention, now):
+    """The partitions retention drops
+
+    >>> expired_keys(["2012-10", "2012-11", "2012-12"], 2,
+    ...              datetime(2012, 12, 12))
+    ['2012-10']
+    >>> expired_keys(["2012-10"], None, datetime(2012, 12, 12))
+    []
+    """
+    oldest = oldest_kept(retention, now)
+    if oldest is None:
+        return []
+    return [key for key in sorted(keys) if key < oldest]
+
+
+def partition_name(name, key):
+    """
+    >>> partition_name("foo", "2012-12")
+    'foo.2012-12'
+    """
+    return "{}.{}".format(name, key)
+
+
+def partition_keys(name, names):
+    """The partitions of name among a list of names
+
+    >>> partition_keys("foo", ["foo", "foo.2012-12", "foo.rollups", "bar"])
+    ['2012-12']
+    """
+    prefix = name + "."
+    return sorted(other[len(prefix):] for other in names
+                  if other.startswith(prefix)
+                  and MONTH_KEY.match(other[len(prefix):]))
@@ -0,0 +1,296 @@
+"""
+Pre-aggregated period rollups, maintained as records are saved
+
+A data set opts in to rollups in its metadata, eg.
+
+    "rollups": {
+        "periods": ["week", "month"],
+        "group_by": ["for_url"]
+    }
+
+Every saved record is added to a bucket for each of the listed periods,
+once across the whole data set and once for its value of each group_by
+field. A bucket holds the record count, the count of values for each field
+and, for numeric fields, the sum, min and max of their values. Period queries
+that only need those can be answered from the buckets instead of grouping
+raw records.
+
+Buckets only cover records saved after rollups are switched on. To switch
+them on for a data set that already has records, build its buckets with
+
+    python start.py --rebuild-rollups <data set id>
+
+while nothing is writing to it. Capped data sets, and partitioned ones with
+a retention, do not keep rollups, their buckets would go on counting records
+that have been evicted or dropped.
+"""
+from collections import defaultdict
+
+import pymongo
+
+from .partitions import parse_partitions
+from ..query import collect_key
+from ..results import is_number
+from ..timeutils import parse_period
+
+
+__all__ = [
+    'Rollups', 'parse_rollups', 'rollup_increments', 'can_use_rollup',
+    'rollup_spec', 'rollup_sort', 'rollup_result', 'BUCKET_INDEX'
+]
+
+
+# Collect functions that can be answered from a bucket
+ROLLUP_FUNCTIONS = ["sum", "count", "mean"]
+
+# Buckets are unique by these fields, in this order
+BUCKET_INDEX = [
+    ("period", pymongo.ASCENDING),
+    ("group_by", pymongo.ASCENDING),
+    ("value", pymongo.ASCENDING),
+    ("start_at", pymongo.ASCENDING),
+]
+
+
+class Rollups(object):
+    def __init__(self, periods, group_by):
+        self.periods = periods
+        self.group_by = group_by
+
+
+def parse_rollups(data_set):
+    """Return the rollups configured for a data set, or None
+
+    Rollups are ignored for capped data sets and for data sets whose
+    partitions have a retention.
+
+    >>> parse_rollups({}) is None
+    True
+    >>> rollups = parse_rollups({"rollups": {"periods": ["week"]}})
+    >>> [period.name for period in rollups.periods], rollups.group_by
+    (['week'], [])
+    >>> parse_rollups({"capped": True, "rollups": {"periods": ["week"]}})
+    >>> parse_rollups({"partitions": {"retention": 12},
+    ...                "rollups": {"periods": ["week"]}})
+    """
+    config = (data_set or {}).get("rollups")
+    if not config or data_set.get("capped"):
+        return None
+    partitions = parse_partitions(data_set)
+    if partitions is not None and partitions.retention is not None:
+        return None
+    return Rollups(
+        [parse_period(name) for name in config.get("periods", [])],
+        config.get("group_by", []))
+
+
+def bucket_key(period, start_at, group_by=None, value=None):
+    """The fields that identify a bucket"""
+    return {
+        "period": period.name,
+        "start_at": start_at,
+        "group_by": group_by,
+        "value": value,
+    }
+
+
+def rollup_increments(records, rollups):
+    """Aggregate records into the updates for each bucket they fall in
+
+    Returns a list of (bucket key, update) pairs, one per bucket.
+
+    >>> from datetime import datetime
+    >>> from backdrop.timeutils import WEEK
+    >>> rollups = Rollups([WEEK], ["foo"])
+    >>> records = [
+    ...     {"_week_start_at": datetime(2012, 12, 10), "foo": "a", "bar": 1},
+    ...     {"_week_start_at": datetime(2012, 12, 10), "foo": "b", "bar": 2}]
+    >>> increments = rollup_increments(records, rollups)
+    >>> [(key['group_by'], key['value']) for key, _ in sorted(increments)]
+    [(None, None), ('foo', 'a'), ('foo', 'b')]
+    >>> sorted(sorted(increments)[0][1]['$inc'].items())
+    [('_count', 2), ('bar:count', 2), ('bar:sum', 3), ('foo:count', 2)]
+    """
+    buckets = defaultdict(Bucket)
+    for record in records:
+        values = rollup_values(record)
+        for period in rollups.periods:
+            start_at = record.get(period.start_at_key)
+            if start_at is None:
+                continue
+            buckets[(period, start_at, None, None)].add(values)
+            for group_by in rollups.group_by:
+                value = record.get(group_by)
+                if value is not None:
+                    buckets[(period, start_at, group_by, value)].add(values)
+
+    return [(bucket_key(*key), bucket.update())
+            for key, bucket in buckets.items()]
+
+
+def rollup_values(record):
+    """The values in a record that are rolled up, ie. not meta fields
+
+    >>> rollup_values({"_id": 1, "foo": 1, "bar": None})
+    {'foo': 1}
+    """
+    return dict((field, value) for field, value in record.items()
+                if not field.startswith("_") and value is not None)
+
+
+class Bucket(object):
+    def __init__(self):
+        self.count = 0
+        self.counts = defaultdict(int)
+        self.sums = defaultdict(int)
+        self.mins = {}
+        self.maxs = {}
+
+    def add(self, values):
+        self.count += 1
+        for field, value in values.items():
+            self.counts[field] += 1
+            if not is_number(value):
+                continue
+            self.sums[field] += value
+            self.mins[field] = min(self.mins.get(field, value), value)
+            self.maxs[field] = max(self.maxs.get(field, value), value)
+
+    def update(self):
+        """A Mongo update merging this bucket into a stored one"""
+        increments = {"_count": self.count}
+        for field, count in self.counts.items():
+            increments[collect_key(field, "count")] = count
+        for field, total in self.sums.items():
+            increments[collect_key(field, "sum")] = total
+
+        update = {"$inc": increments}
+        if self.mins:
+            update["$min"] = dict((collect_key(field, "min"), value)
+                                  for field, value in self.mins.items())
+            update["$max"] = dict((collect_key(field, "max"), value)
+                                  for field, value in self.maxs.items())
+        return update
+
+
+def can_use_rollup(query, rollups):
+    """Check whether a query can be answered from rollup buckets
+
+    >>> from datetime import datetime
+    >>> from backdrop.timeutils import WEEK, DAY
+    >>> rollups = Rollups([WEEK], ["foo"])
+    >>> can_use_rollup({"period": WEEK, "collect": [["bar", "sum"]]}, rollups)
+    True
+    >>> can_use_rollup({"period": DAY}, rollups)
+    False
+    >>> can_use_rollup({"period": WEEK, "collect": [["bar", "set"]]}, rollups)
+    False
+    >>> can_use_rollup({"period": WEEK, "group_by": "bar"}, rollups)
+    False
+    >>> can_use_rollup({"period": WEEK, "filter_by": {"foo": "a"}}, rollups)
+    True
+    >>> can_use_rollup({"period": WEEK,
+    ...                 "start_at": datetime(2012, 12, 12)}, rollups)
+    False
+    """
+    period = query.get("period")
+    if rollups is None or period not in rollups.periods:
+        return False
+
+    group_by = query.get("group_by")
+    if group_by and group_by not in rollups.group_by:
+        return False
+
+    # Only a filter on the grouped field maps onto a bucket
+    filter_fields = query.get("filter_by", {}).keys()
+    if len(filter_fields) > 1:
+        return False
+    if filter_fields and (filter_fields[0] not in rollups.group_by
+                          or group_by not in (None, filter_fields[0])):
+        return False
+
+    for field, function in query.get("collect", []):
+        if function not in ROLLUP_FUNCTIONS:
+            return False
+
+    # Buckets cover whole periods so the range must fall on boundaries
+    for field in ["start_at", "end_at"]:
+        if field in query and period.start(query[field]) != query[field]:
+            return False
+
+    return True
+
+
+def rollup_spec(query):
+    """Build the bucket query for a query that can use a rollup
+
+    >>> from backdrop.timeutils import WEEK
+    >>> sorted(rollup_spec({"period": WEEK, "filter_by": {"foo": "a"}}).items())
+    [('group_by', 'foo'), ('period', 'week'), ('value', 'a')]
+    """
+    spec = {"period": query["period"].name}
+
+    filter_by = query.get("filter_by", {})
+    group_by = query.get("group_by") or (filter_by.keys() or [None])[0]
+    spec["group_by"] = group_by
+    if group_by in filter_by:
+        spec["value"] = filter_by[group_by]
+    elif group_by is not None:
+        spec["value"] = {"$ne": None}
+
+    start_at, end_at = query.get("start_at"), query.get("end_at")
+    if start_at or end_at:
+        spec["start_at"] = {}
+        if start_at:
+            spec["start_at"]["$gte"] = start_at
+        if end_at:
+            spec["start_at"]["$lt"] = end_at
+
+    return spec
+
+
+def rollup_sort(query):
+    """Sort buckets as the group keys of the equivalent group query
+
+    >>> rollup_sort({})
+    [('value', 1), ('start_at', 1)]
+    >>> rollup_sort({"group_by": "foo",
+    ...              "sort_by": {"field": "foo", "direction": "descending"}})
+    [('value', -1), ('start_at', 1)]
+    """
+    sort_by = query.get("sort_by")
+    if sort_by and sort_by["field"] == query.get("group_by") \
+            and sort_by["direction"] == "descending":
+        return [("value", pymongo.DESCENDING), ("start_at", pymongo.ASCENDING)]
+    return [("value", pymongo.ASCENDING), ("start_at", pymongo.ASCENDING)]
+
+
+def rollup_result(bucket, query):
+    """Turn a stored bucket into a result as a group query would return it
+
+    >>> from datetime import datetime
+    >>> from backdrop.timeutils import WEEK
+    >>> bucket = {"period": "week", "start_at": datetime(2012, 12, 10),
+    ...           "group_by": "foo", "value": "a", "_count": 2,
+    ...           "bar:sum": 3, "bar:count": 2}
+    >>> sorted(rollup_result(bucket, {"period": WEEK, "group_by": "foo",
+    ...     "collect": [["bar", "mean"]]}).items())
+    [('_count', 2), ('_week_start_at', datetime.datetime(2012, 12, 10, 0, 0)), ('bar:mean', 1.5), ('foo', 'a')]
+    """
+    result = {
+        query["period"].start_at_key: bucket["start_at"],
+        "_count": bucket["_count"],
+    }
+    if query.get("group_by"):
+        result[query["group_by"]] = bucket["value"]
+
+    for field, function in query.get("collect", []):
+        count = bucket.get(collect_key(field, "count"), 0)
+        total = bucket.get(collect_key(field, "sum"), 0)
+        result[collect_key(field, function)] = {
+            "count": count,
+            "sum": total,
+            "mean": float(total) / count if count else None,
+        }[function]
+
+    return result
@@ -0,0 +1,125 @@
+from .local import LocalData
+from .base import iter_rows
+from ..data import add_meta_fields
+from ..query import PageToken
+from ..timeutils import WEEK, UTC
+from datetime import datetime
+import unittest
+import tempfile
+import shutil
+
+
+def at(month, day):
+    return datetime(2012, month, day, 12, tzinfo=UTC)
+
+
+class LocalDataTestCase(unittest.TestCase):
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        self.data = LocalData(self.base_path)
+        self.data.create("foo", False, 0, {})
+
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+
+    def add_records(self, data=None):
+        (data or self.data).save("foo", map(add_meta_fields, [
+            {"_timestamp": at(11, 26), "for_url": "/a", "visitors": 1},
+            {"_timestamp": at(12, 3), "for_url": "/b", "visitors": 2},
+            {"_timestamp": at(12, 5), "for_url": "/a", "visitors": 3},
+            {"_timestamp": at(12, 12), "for_url": "/a", "visitors": 4},
+            {"for_url": "/c", "visitors": 5},
+        ]))
+
+
+    def query(self, query, data=None):
+        return list(iter_rows((data or self.data).query("foo", query)))
+
+
+    def test_never_created_data_set_is_empty(self):
+        assert self.query({}, LocalData(tempfile.mkdtemp(
+            dir=self.base_path))) == []
+
+
+    def test_save_creates_data_set(self):
+        data = LocalData(self.base_path)
+        data.save("bar", [{"a": 1}])
+
+        assert [row["a"] for row in iter_rows(data.query("bar", {}))] == [1]
+
+
+    def test_filter_by(self):
+        self.add_records()
+
+        rows = self.query({"filter_by": {"for_url": "/a"}})
+
+        assert sorted(row["visitors"] for row in rows) == [1, 3, 4]
+
+
+    def test_group_by(self):
+        self.add_records()
+
+        rows = self.query({"group_by": "for_url",
+                           "collect": [["visitors", "sum"]]})
+
+        assert [(row["for_url"], row["_count"], row["visitors"])
+                for row in rows] == \
+            [("/a", 3, [1, 3, 4]), ("/b", 1, [2]), ("/c", 1, [5])]
+
+
+    def test_period(self):
+        self.add_records()
+
+        rows = self.query({"period": WEEK})
+
+        assert [(row["_week_start_at"], row["_count"]) for row in rows] == [
+            (datetime(2012, 11, 26, tzinfo=UTC), 1),
+            (datetime(2012, 12, 3, tzinfo=UTC), 2),
+            (datetime(2012, 12, 10, tzinfo=UTC), 1)]
+
+
+    def test_sort_and_limit(self):
+        self.add_records()
+
+        rows = self.query({"sort_by": {"field": "visitors",
+                                       "direction": "descending"},
+                           "limit": 2})
+
+        assert [row["visitors"] for row in rows] == [5, 4]
+
+
+    def test_pages(self):
+        self.add_records()
+        query = {"sort_by": {"field": "visitors", "direction": "ascending"},
+                 "page_size": 2}
+
+        first = self.query(query)
+        last = first[1]
+        query["page_token"] = PageToken("visitors", last["visitors"],
+                                        last["_id"])
+        second = self.query(query)
+
+        assert [row["visitors"] for row in first] == [1, 2, 3]
+        assert [row["visitors"] for row in second] == [3, 4, 5]
+
+
+    def test_time_range(self):
+        self.add_records()
+
+        rows = self.query({"start_at": at(12, 1), "end_at": at(12, 12)})
+
+        assert [row["visitors"] for row in rows] == [2, 3]
+
+
+    def test_appends_from_another_process(self):
+        self.add_records()
+        other = LocalData(self.base_path)
+        self.add_records(other)
+        self.add_records()
+
+        rows = self.query({"start_at": at(12, 1)})
+
+        assert [row["visitors"] for row in rows] == [2, 3, 4] * 3
+        assert len(self.query({}, other)) == 15
@@ -1,4 +1,4 @@
-from .webapp import app
+from .webapp import app, query_cache, ingest_queue, datasets, datasets_data
 import unittest
 import json
 import pymongo
@@ -7,24 +7,131 @@ class FlaskTestCase(unittest.TestCase):
     def setUp(self):
         app.config['TESTING'] = True
         self.app = app.test_client()
+        query_cache.clear()
 
 
     def tearDown(self):
         pymongo.Connection()['backdroop']['foobar'].drop()
+        pymongo.Connection()['backdroop']['foobar_async'].drop()
+        for name in pymongo.Connection()['backdroop'].collection_names():
+            if name.startswith(('foobar_partitioned', 'foobar_rollups')):
+                pymongo.Connection()['backdroop'][name].drop()
+        datasets_data.refresh_collections()
 
 
-    def add_records(self):
+    def add_records(self, data_set_id='foobar'):
         payload = json.dumps([
             {"_timestamp": "2012-12-12T12:12:12+00:00", "unique_visitors": 1234},
             {"_timestamp": "2012-12-13T12:12;12+00:00", "unique_visitors": 4321},
             {"_timestamp": "2012-12-21T12:12;12+00:00", "unique_visitors": 4321},
             {"_timestamp": "2013-02-01T12:12;12+00:00", "unique_visitors": 4321},
         ])
-        self.app.post('/data-sets/foobar/data',
+        self.app.post('/data-sets/{}/data'.format(data_set_id),
                 data=payload,
                 content_type='application/json')
 
 
+    def test_post_returns_saved_count(self):
+        payload = json.dumps([
+            {"_timestamp": "2012-12-12T12:12:12+00:00", "unique_visitors": 1},
+            {"_timestamp": "2012-12-12T13:12:12+00:00", "unique_visitors": 2},
+        ])
+        result = self.app.post('/data-sets/foobar/data',
+                data=payload,
+                content_type='application/json')
+        data = json.loads(result.data)
+
+        assert data == {"status": "ok", "saved": 2}
+
+
+    def test_post_recreates_dropped_collection(self):
+        self.add_records()
+        pymongo.Connection()['backdroop']['foobar'].drop()
+        datasets_data.refresh_collections()
+
+        self.add_records()
+        indexes = pymongo.Connection()['backdroop']['foobar'] \
+            .index_information()
+
+        assert any(key == [('_timestamp', 1)]
+                   for key in (index['key'] for index in indexes.values()))
+
+
+    def test_post_ndjson(self):
+        payload = "\n".join([
+            '{"_timestamp": "2012-12-12T12:12:12+00:00", "unique_visitors": 1}',
+            '{"_timestamp": "2012-12-12T13:12:12+00:00", "unique_visitors": 2}',
+            '{"_timestamp": "2012-12-12T14:12:12+00:00", "unique_visitors": 3}',
+        ])
+        result = self.app.post('/data-sets/foobar/data',
+                data=payload,
+                content_type='application/x-ndjson')
+        data = json.loads(result.data)
+
+        assert data == {"status": "ok", "saved": 3}
+
+
+    def test_post_invalid_record_returns_its_position(self):
+        payload = json.dumps([
+            {"_timestamp": "2012-12-12T12:12:12+00:00", "unique_visitors": 1},
+            {"_timestamp": "2012-12-12T13:12:12+00:00", "unique_visitors": -1},
+        ])
+        result = self.app.post('/data-sets/foobar/data',
+                data=payload,
+                content_type='application/json')
+        data = json.loads(result.data)
+
+        assert result.status_code == 400
+        assert data['index'] == 1
+
+
+    def test_post_invalid_record_saves_nothing(self):
+        records = [{"_timestamp": "2012-12-12T12:12:12+00:00",
+                    "unique_visitors": 1}] * 1500
+        records[1200] = {"_timestamp": "2012-12-12T12:12:12+00:00",
+                         "unique_visitors": -1}
+        result = self.app.post('/data-sets/foobar/data',
+                data=json.dumps(records),
+                content_type='application/json')
+
+        assert result.status_code == 400
+        assert json.loads(result.data)['index'] == 1200
+        assert json.loads(self.app.get('/data-sets/foobar/data').data) == []
+
+
+    def test_post_malformed_ndjson_saves_nothing(self):
+        lines = ['{"_timestamp": "2012-12-12T12:12:12+00:00", '
+                 '"unique_visitors": 1}'] * 6000
+        lines[5500] = '{"_timestamp": '
+        result = self.app.post('/data-sets/foobar/data',
+                data="\n".join(lines),
+                content_type='application/x-ndjson')
+
+        assert result.status_code == 400
+        assert json.loads(result.data)['index'] == 5500
+        assert json.loads(self.app.get('/data-sets/foobar/data').data) == []
+
+
+    def test_post_async_returns_receipt(self):
+        payload = json.dumps([
+            {"_timestamp": "2012-12-12T12:12:12+00:00", "unique_visitors": 1},
+            {"_timestamp": "2012-12-12T13:12:12+00:00", "unique_visitors": 2},
+        ])
+        result = self.app.post('/data-sets/foobar_async/data',
+                data=payload,
+                content_type='application/json')
+        data = json.loads(result.data)
+
+        assert result.status_code == 202
+        assert data['status'] == "queued"
+
+        ingest_queue.join()
+        receipt = json.loads(self.app.get(result.headers['Location']).data)
+
+        assert receipt['status'] == "saved"
+        assert receipt['saved'] == 2
+
+
     def test_raw_query(self):
         self.add_records()
         
@@ -36,6 +143,71 @@ class FlaskTestCase(unittest.TestCase):
         assert data[1]['_timestamp'] == "2012-12-13T12:12:00+00:00"
 
 
+    def test_raw_query_as_ndjson(self):
+        self.add_records()
+
+        result = self.app.get('/data-sets/foobar/data?format=ndjson')
+        lines = result.data.splitlines()
+
+        assert result.mimetype == "application/x-ndjson"
+        assert len(lines) == 4
+        assert json.loads(lines[0])['unique_visitors'] == 1234
+
+
+    def test_raw_query_fields(self):
+        self.add_records()
+
+        result = self.app.get('/data-sets/foobar/data?fields=unique_visitors')
+        data = json.loads(result.data)
+
+        assert len(data) == 4
+        assert data[0] == {"unique_visitors": 1234}
+
+
+    def test_raw_query_pages(self):
+        self.add_records()
+
+        first = self.app.get('/data-sets/foobar/data'
+                             '?page_size=3&sort_by=_timestamp:descending')
+        link = first.headers["Link"]
+        assert link.endswith('>; rel="next"')
+
+        last = self.app.get(link[1:link.index(">")])
+
+        timestamps = [result["_timestamp"] for result in
+                      json.loads(first.data) + json.loads(last.data)]
+        assert timestamps == sorted(timestamps, reverse=True)
+        assert len(timestamps) == 4
+        assert "Link" not in last.headers
+
+
+    def test_invalid_page_token(self):
+        result = self.app.get('/data-sets/foobar/data'
+                              '?page_size=2&page_token=zzzz')
+
+        assert result.status_code == 400
+        assert json.loads(result.data)['message'] == "Invalid page token"
+
+
+    def test_filter_by_unknown_field(self):
+        result = self.app.get('/data-sets/foobar/data?filter_by=nope:1')
+
+        assert result.status_code == 400
+        assert json.loads(result.data)['message'] == \
+            "Cannot filter by nope, field not present"
+
+
+    def test_pretty_query(self):
+        self.add_records()
+
+        compact = self.app.get('/data-sets/foobar/data?period=week')
+        pretty = self.app.get('/data-sets/foobar/data?period=week&pretty=true')
+
+        assert "\n" not in compact.data
+        assert pretty.data.startswith("[\n  {")
+        assert json.loads(compact.data) == json.loads(pretty.data)
+
+
     def test_group_by(self):
         self.add_records()
 
@@ -47,6 +219,132 @@ class FlaskTestCase(unittest.TestCase):
         assert data[0]['unique_visitors'] == 1234
 
 
+    def test_period_collect(self):
+        self.add_records()
+
+        result = self.app.get('/data-sets/foobar/data?period=week'
+                              '&collect=unique_visitors:sum'
+                              '&collect=unique_visitors:mean')
+        data = json.loads(result.data)
+
+        assert data[0]['unique_visitors:sum'] == 1234 + 4321
+        assert data[0]['unique_visitors:mean'] == (1234 + 4321) / 2.0
+
+
+    def test_repeated_query_is_cached(self):
+        self.add_records()
+
+        first = self.app.get('/data-sets/foobar/data?period=week')
+        second = self.app.get('/data-sets/foobar/data?period=week')
+        status = json.loads(self.app.get('/_status').data)
+
+        assert first.data == second.data
+        assert status['cache']['hits'] == 1
+        assert status['cache']['misses'] == 1
+
+
+    def test_metrics(self):
+        self.add_records()
+        # Timings are recorded once the server closes the response
+        self.app.get('/data-sets/foobar/data').close()
+
+        result = self.app.get('/_metrics')
+
+        assert result.mimetype == "text/plain"
+        assert 'backdrop_stage_seconds_count{data_set="foobar",stage="query"}' \
+            in result.data
+        assert 'backdrop_records_total{data_set="foobar",outcome="saved"}' \
+            in result.data
+
+
+    def test_metrics_for_unknown_data_sets(self):
+        for index in range(5):
+            self.app.get('/data-sets/nonexistent-{}/data'.format(index)) \
+                .close()
+
+        result = self.app.get('/_metrics')
+
+        assert 'nonexistent' not in result.data
+        assert 'backdrop_requests_total{data_set="unknown",' \
+            'endpoint="query_data_set",status="404"} 5' in result.data
+
+
+    def test_period_zero_filled(self):
+        self.add_records()
+
+        result = self.app.get('/data-sets/foobar/data?period=week&fill=zero'
+                              '&start_at=2012-12-10T00:00:00Z'
+                              '&end_at=2013-02-04T00:00:00Z')
+        data = json.loads(result.data)
+
+        assert len(data) == 8
+        assert data[2]['_start_at'] == "2012-12-24T00:00:00+00:00"
+        assert data[2]['_count'] == 0
+
+
+    def test_partitioned_queries(self):
+        self.add_records('foobar_partitioned')
+
+        names = pymongo.Connection()['backdroop'].collection_names()
+        assert 'foobar_partitioned.2012-12' in names
+        assert 'foobar_partitioned.2013-02' in names
+
+        raw = json.loads(self.app.get(
+            '/data-sets/foobar_partitioned/data'
+            '?sort_by=_timestamp:descending').data)
+        in_range = json.loads(self.app.get(
+            '/data-sets/foobar_partitioned/data'
+            '?start_at=2013-01-01T00:00:00Z&end_at=2013-03-01T00:00:00Z').data)
+        weeks = json.loads(self.app.get(
+            '/data-sets/foobar_partitioned/data?period=week'
+            '&collect=unique_visitors:sum').data)
+
+        assert [result['unique_visitors'] for result in raw] == \
+            [4321, 4321, 4321, 1234]
+        assert len(in_range) == 1
+        assert [week['unique_visitors:sum'] for week in weeks] == \
+            [1234 + 4321, 4321, 4321]
+
+
+    def test_rollups_match_raw_records(self):
+        payload = json.dumps([
+            {"_timestamp": "2012-12-12T12:12:12+00:00", "for_url": "/a",
+             "unique_visitors": 1},
+            {"_timestamp": "2012-12-13T12:12:12+00:00", "for_url": "/b",
+             "unique_visitors": 2},
+            {"_timestamp": "2012-12-21T12:12:12+00:00", "for_url": "/a",
+             "unique_visitors": 4},
+            {"_timestamp": "2013-01-01T12:12:12+00:00", "unique_visitors": 8},
+        ])
+        for data_set_id in ['foobar', 'foobar_rollups']:
+            self.app.post('/data-sets/{}/data'.format(data_set_id),
+                          data=payload, content_type='application/json')
+
+        def query_both(query):
+            return [json.loads(self.app.get(
+                '/data-sets/{}/data?{}'.format(data_set_id, query)).data)
+                for data_set_id in ['foobar', 'foobar_rollups']]
+
+        queries = [
+            'period=week',
+            'period=week&filter_by=for_url:/a&collect=unique_visitors:mean',
+            'period=month&group_by=for_url&collect=unique_visitors:sum'
+            '&collect=unique_visitors:count',
+        ]
+        for query in queries:
+            raw, rolled_up = query_both(query)
+            assert raw == rolled_up, query
+            assert raw
+
+        # Buckets built afterwards from the saved records match too
+        rollups = pymongo.Connection()['backdroop']['foobar_rollups.rollups']
+        buckets = sorted(rollups.find({}, {"_id": 0}))
+        rollups.drop()
+        datasets_data.rebuild_rollups('foobar_rollups',
+                                      datasets.get('foobar_rollups'))
+        assert sorted(rollups.find({}, {"_id": 0})) == buckets
+
+
     def test_period(self):
         self.add_records()
 
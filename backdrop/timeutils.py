@@ -1,13 +1,16 @@
 from datetime import timedelta, time, datetime
-import time as _time
+import calendar
+import re
+from itertools import izip
 from dateutil.relativedelta import relativedelta, MO
 import pytz
-from dateutil import parser
+from dateutil import parser, tz
 
 
 __all__ = [
     'HOUR', 'DAY', 'WEEK', 'MONTH', 'QUARTER', 'PERIODS',
-    'parse_period', 'parse_time_as_utc', 'as_utc'
+    'parse_period', 'parse_time_as_utc', 'as_utc', 'parse_datetime',
+    'period_starts'
 ]
 
 
@@ -39,11 +42,46 @@ class Period(object):
             yield (_start, _start + self._delta)
             _start += self._delta
 
+    def boundaries(self, start, end):
+        """Return the boundaries of the periods in range as epoch seconds
+
+        The same periods as range, as a list of every start followed by
+        the end of the last period.
+
+        >>> DAY.boundaries(datetime(2012, 12, 12), datetime(2012, 12, 14))
+        [1355270400, 1355356800, 1355443200]
+        >>> len(QUARTER.boundaries(datetime(2012, 1, 1), datetime(2013, 1, 1)))
+        5
+        """
+        first = _time_to_index(self.start(start))
+        last = _time_to_index(self.end(end))
+        if first >= last:
+            return []
+        return self._boundaries(first, last)
+
+    def _boundaries(self, first, last):
+        return range(first, last + 1, self._seconds)
+
+
+class MonthsPeriod(Period):
+    def _boundaries(self, first, last):
+        start = datetime.utcfromtimestamp(first)
+        month_index = start.year * 12 + start.month - 1
+        boundaries = []
+        while True:
+            year, month = divmod(month_index, 12)
+            boundary = calendar.timegm((year, month + 1, 1, 0, 0, 0))
+            if boundary > last:
+                return boundaries
+            boundaries.append(boundary)
+            month_index += self._months
+
 
 class Hour(Period):
     def __init__(self):
         self.name = "hour"
         self._delta = timedelta(hours=1)
+        self._seconds = 60 * 60
 
     def _is_boundary(self, timestamp):
         return self.valid_start_at(timestamp)
@@ -59,6 +97,7 @@ class Day(Period):
     def __init__(self):
         self.name = "day"
         self._delta = timedelta(days=1)
+        self._seconds = 24 * 60 * 60
 
     def start(self, timestamp):
         return _truncate_time(timestamp)
@@ -71,6 +110,7 @@ class Week(Period):
     def __init__(self):
         self.name = "week"
         self._delta = timedelta(days=7)
+        self._seconds = 7 * 24 * 60 * 60
 
     def start(self, timestamp):
         return _truncate_time(timestamp) + relativedelta(weekday=MO(-1))
@@ -79,10 +119,11 @@ class Week(Period):
         return timestamp.weekday() is 0
 
 
-class Month(Period):
+class Month(MonthsPeriod):
     def __init__(self):
         self.name = "month"
         self._delta = relativedelta(months=1)
+        self._months = 1
 
     def start(self, timestamp):
         return timestamp.replace(day=1, hour=0, minute=0,
@@ -92,10 +133,11 @@ class Month(Period):
         return timestamp.day == 1
 
 
-class Quarter(Period):
+class Quarter(MonthsPeriod):
     def __init__(self):
         self.name = "quarter"
         self._delta = relativedelta(months=3)
+        self._months = 3
         self.quarter_starts = [10, 7, 4, 1]
 
     def start(self, timestamp):
@@ -117,51 +159,122 @@ QUARTER = Quarter()
 PERIODS = [HOUR, DAY, WEEK, MONTH, QUARTER]
 
 
+PERIOD_START_KEYS = [period.start_at_key for period in PERIODS]
+
+
 def parse_period(period_name):
     for period in PERIODS:
         if period.name == period_name:
             return period
 
 
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.UTC)
+
+
 def _time_to_index(dt):
-    return _time.mktime(dt.replace(tzinfo=pytz.utc).timetuple())
+    """Seconds since the epoch, naive datetimes are taken to be UTC"""
+    return calendar.timegm(dt.utctimetuple())
+
+
+def _time_from_index(index):
+    return EPOCH + timedelta(seconds=index)
 
 
 def timeseries(start, end, period, data, default):
+    """Return an entry for every period from start to end
+
+    Entries are taken from data by their _start_at, periods with no data
+    get a copy of default with _start_at and _end_at added.
+
+    >>> series = timeseries(datetime(2012, 12, 1), datetime(2013, 3, 1), MONTH,
+    ...     [{"_start_at": datetime(2013, 1, 1, tzinfo=pytz.UTC), "_count": 5}],
+    ...     {"_count": 0})
+    >>> [(entry["_start_at"].month, entry["_count"]) for entry in series]
+    [(12, 0), (1, 5), (2, 0)]
+    >>> series[0]["_end_at"]
+    datetime.datetime(2013, 1, 1, 0, 0, tzinfo=<UTC>)
+    """
     data_by_start_at = _index_by_start_at(data)
+    boundaries = period.boundaries(start, end)
 
     def entry(start, end):
-        time_index = _time_to_index(start)
-        if time_index in data_by_start_at:
-            return data_by_start_at[time_index]
-        else:
-            return _merge(default, _period_limits(start, end))
-    return [entry(start, end) for start, end in period.range(start, end)]
-
+        if start in data_by_start_at:
+            return data_by_start_at[start]
+        entry = dict(default)
+        entry["_start_at"] = _time_from_index(start)
+        entry["_end_at"] = _time_from_index(end)
+        return entry
 
-def _period_limits(start, end):
-    return {
-        "_start_at": start,
-        "_end_at": end
-    }
+    return [entry(start, end)
+            for start, end in izip(boundaries, boundaries[1:])]
 
 
 def _index_by_start_at(data):
     return dict((_time_to_index(d["_start_at"]), d) for d in data)
 
 
-def _period_range(start, stop, period):
-    while start < stop:
-        yield (start, start + period)
-        start += period
+def _truncate_time(datetime):
+    return datetime.replace(hour=0, minute=0, second=0, microsecond=0)
 
 
-def _merge(first, second):
-    return dict(first.items() + second.items())
+RFC3339 = re.compile(
+    r"^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6})\d*)?"
+    r"(Z|[+-]\d\d:\d\d)$")
 
+UTC = tz.tzutc()
 
-def _truncate_time(datetime):
-    return datetime.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def parse_datetime(value):
+    """Parse a timestamp, with a fast path for RFC3339
+
+    Anything not in the YYYY-MM-DDTHH:MM:SS+HH:MM shape, with optional
+    fractional seconds or Z for UTC, is parsed by dateutil.
+
+    >>> parse_datetime("2012-12-12T12:12:12+00:00")
+    datetime.datetime(2012, 12, 12, 12, 12, 12, tzinfo=tzutc())
+    >>> parse_datetime("2012-12-12T12:12:12.25-05:30")
+    datetime.datetime(2012, 12, 12, 12, 12, 12, 250000, tzinfo=tzoffset(None, -19800))
+    >>> parse_datetime("12 December 2012")
+    datetime.datetime(2012, 12, 12, 0, 0)
+    """
+    match = RFC3339.match(value)
+    if match is None:
+        return parser.parse(value)
+
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    return datetime(int(year), int(month), int(day),
+                    int(hour), int(minute), int(second),
+                    int(fraction.ljust(6, "0")) if fraction else 0,
+                    _parse_offset(offset))
+
+
+def _parse_offset(offset):
+    if offset in ("Z", "+00:00", "-00:00"):
+        return UTC
+    minutes = int(offset[1:3]) * 60 + int(offset[4:6])
+    return tz.tzoffset(None, minutes * 60 * (-1 if offset[0] == "-" else 1))
+
+
+def period_starts(timestamp):
+    """Return the start of every period a timestamp falls in
+
+    All of the starts are worked out together from the start of the hour.
+
+    >>> starts = period_starts(datetime(2012, 12, 12, 12, 12))
+    >>> [starts[key].isoformat() for key in PERIOD_START_KEYS]
+    ['2012-12-12T12:00:00', '2012-12-12T00:00:00', '2012-12-10T00:00:00', '2012-12-01T00:00:00', '2012-10-01T00:00:00']
+    """
+    hour = timestamp.replace(minute=0, second=0, microsecond=0)
+    day = hour.replace(hour=0)
+    month = day.replace(day=1)
+
+    return dict(izip(PERIOD_START_KEYS, [
+        hour,
+        day,
+        day - timedelta(days=day.weekday()),
+        month,
+        month.replace(month=month.month - (month.month - 1) % 3),
+    ]))
 
 
 def parse_time_as_utc(time_string):
@@ -174,7 +287,7 @@ def parse_time_as_utc(time_string):
     if isinstance(time_string, datetime):
         time = time_string
     else:
-        time = parser.parse(time_string)
+        time = parse_datetime(time_string)
     return as_utc(time)
 
 
@@ -1,25 +1,125 @@
-import json
+import atexit
+from itertools import chain, imap, islice
 
-from flask import Flask, request
-from bson import ObjectId
-import datetime
+from flask import Flask, request, g
+from jsonschema import ValidationError as InvalidQueryArgs
+from werkzeug.urls import url_encode
 
 from .models import FilesystemDataSets, NotFound
+from .storage.base import ResultBatch, iter_rows
 from .storage.mongo import MongoData
-from .data import create_record_parser
-from .query import parse_query
-from .results import create_result_builder
+from .storage.local import LocalData
+from .storage.connections import ConnectionConfig
+from .data import (RecordParsers, RecordPool, InvalidRecord, read_ndjson,
+                   spool_records, error_message)
+from .query import QueryPlans, ValidationError, split_response_args, \
+    page_token, is_group_query
+from .results import create_result_builder, fill_gaps
+from .cache import QueryCache, normalise_query
+from .serialise import encode, encode_batches
+from .ingest import IngestQueue, QueueFull
+from .metrics import Metrics, SampledProfiler
 
 
 app = Flask("backdrop.webapp")
 
+NDJSON_MIMETYPE = "application/x-ndjson"
+PROMETHEUS_MIMETYPE = "text/plain; version=0.0.4"
+
+# Streamed responses are written in chunks of roughly this many bytes
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Processes that parse large uploads, 0 parses them in the request
+PARSER_PROCESSES = 0
+
+# Seconds an async upload waits for room in a full ingest queue
+INGEST_TIMEOUT = 1
+
+# Fraction of requests to profile, profiles of requests slower than
+# PROFILE_SLOW seconds are written to PROFILE_DIR
+PROFILE_RATE = 0
+PROFILE_SLOW = 1.0
+PROFILE_DIR = None
+
+# Requests are timed under this data set until the one they name is found,
+# so unknown ids do not each add their own metrics
+UNKNOWN_DATA_SET = "unknown"
+
+# Mongo host, or replica set seed list, and connection settings
+MONGO_HOST = 'localhost'
+MONGO_CONFIG = ConnectionConfig()
+
 datasets = FilesystemDataSets()
-datasets_data = MongoData('localhost', 'backdroop')
+datasets_data = MongoData(MONGO_HOST, 'backdroop', config=MONGO_CONFIG)
+record_parsers = RecordParsers()
+record_pool = RecordPool(record_parsers, processes=PARSER_PROCESSES)
+query_plans = QueryPlans()
+query_cache = QueryCache()
+metrics = Metrics()
+profiler = SampledProfiler(PROFILE_RATE, PROFILE_SLOW, PROFILE_DIR)
+
+
+def use_local_data(base_path):
+    """Keep data sets in local files under base_path instead of Mongo"""
+    global datasets_data
+    datasets_data = LocalData(base_path)
+    return datasets_data
+
+
+def save_records(data_set_id, records, data_set):
+    return datasets_data.save(data_set_id, records, data_set)
+
+
+def invalidate_cached_queries(data_set_id, data_set):
+    """Drop the cached queries for a data set that has been written to
+
+    Data sets with a cache TTL are left to expire instead.
+    """
+    if cache_ttl(data_set) is None:
+        query_cache.invalidate(data_set_id)
+
+
+# Records for data sets with async ingest are written in the background,
+# and what is still queued is written before the process exits
+ingest_queue = IngestQueue(save_records,
+                           on_written=invalidate_cached_queries)
+atexit.register(ingest_queue.close)
+
+
+@app.before_request
+def start_request_timer():
+    data_set_id = (request.view_args or {}).get("data_set_id")
+    g.timer = metrics.timer(UNKNOWN_DATA_SET if data_set_id else None,
+                            request.endpoint)
+    g.profile = profiler.start()
+
+
+@app.after_request
+def finish_request_timer(response):
+    """Record a request's timings once the last of its body is sent
+
+    Raw query results are read and encoded while the body is streamed.
+    """
+    timer, profile = g.timer, g.profile
+
+    def finish():
+        timer.finish(response.status_code)
+        profiler.stop(profile, timer.elapsed(), "{}-{}".format(
+            timer.endpoint, timer.data_set_id or "none"))
+
+    response.call_on_close(finish)
+    return response
 
 
 @app.route("/_status", methods=["GET"])
 def status():
-    return "ok"
+    return jsonify({"status": "ok", "cache": query_cache.stats(),
+                    "ingest": ingest_queue.stats()})
+
+
+@app.route("/_metrics", methods=["GET"])
+def get_metrics():
+    return app.response_class(metrics.render(), mimetype=PROMETHEUS_MIMETYPE)
 
 
 @app.route("/data-sets", methods=["GET"])
@@ -30,15 +130,21 @@ def list_data_sets():
 @app.route("/data-sets/<data_set_id>", methods=["GET"])
 def get_a_data_set(data_set_id):
     try:
-        return jsonify(datasets.get(data_set_id))
+        data_set = datasets.get(data_set_id)
+        g.timer.data_set_id = data_set_id
+        return jsonify(data_set)
     except NotFound:
         return jsonify({"error": "Not found"}), 404
 
 
 @app.route("/data-sets/<data_set_id>/data", methods=["POST"])
 def post_to_data_set(data_set_id):
+    timer = g.timer
     try:
-        data_set = datasets.get(data_set_id)
+        with timer.stage("metadata"):
+            version, data_set, schema_index = datasets.entry(data_set_id)
+            datetime_fields = schema_index.datetime_fields
+        timer.data_set_id = data_set_id
 
         # Create the data set if it doesn't exist
         if not datasets_data.exists(data_set_id):
@@ -48,49 +154,253 @@ def post_to_data_set(data_set_id):
                     data_set.get("cap_size", 0),
                     data_set.get("schema", {}))
 
-        records = listify(request.json)
+        # Newline delimited uploads are read one record at a time
+        if request.mimetype == NDJSON_MIMETYPE:
+            records = read_ndjson(request.stream)
+        else:
+            records = listify(request.json)
 
-        # Validate and parse incoming records
-        records = map(create_record_parser(data_set['schema']), records)
+        # Validate and parse incoming records, large uploads may be parsed
+        # in other processes
+        records = timer.wrap("parse", record_pool.parse(
+                data_set_id, version, data_set['schema'], datetime_fields,
+                records))
 
-        # Save the incoming records
-        datasets_data.save(data_set_id, records)
-        
-        return jsonify({"status": "ok", "saved": len(records)})
+        # Records for async data sets are all validated before any are
+        # queued, then written in the background
+        if is_async_ingest(data_set):
+            return queue_records(data_set_id, data_set, records)
+
+        # Every record is parsed before any are saved, so an upload with an
+        # invalid record saves nothing. Newline delimited uploads are
+        # spooled to a temporary file rather than held in memory.
+        if request.mimetype == NDJSON_MIMETYPE:
+            records = spool_records(records)
+        else:
+            records = list(records)
+
+        # Save the incoming records, storage writes them in batches
+        try:
+            with timer.stage("save"):
+                saved, failed = datasets_data.save(
+                    data_set_id, records, data_set)
+        finally:
+            invalidate_cached_queries(data_set_id, data_set)
+        count_records(data_set_id, saved=saved, failed=len(failed))
+
+        if failed:
+            return jsonify({"status": "error", "saved": saved,
+                            "failed": failed}), 500
+        return jsonify({"status": "ok", "saved": saved})
+    except InvalidRecord as e:
+        return jsonify({"status": "error", "message": e.message,
+                        "index": e.index}), 400
     except NotFound:
         return jsonify({"error":"Not found"}), 404
 
 
+@app.route("/ingest-receipts/<receipt_id>", methods=["GET"])
+def get_ingest_receipt(receipt_id):
+    receipt = ingest_queue.receipt(receipt_id)
+    if receipt is None:
+        return jsonify({"error": "Not found"}), 404
+    return jsonify(receipt.as_dict())
+
+
 @app.route("/data-sets/<data_set_id>/data", methods=["GET"])
 def query_data_set(data_set_id):
+    timer = g.timer
     try:
-        data_set = datasets.get(data_set_id)
-   
-        query = parse_query(request.args, data_set['schema'])
+        with timer.stage("metadata"):
+            version, data_set, _ = datasets.entry(data_set_id)
+        timer.data_set_id = data_set_id
+
+        options, query_args = split_response_args(request.args)
+        # Repeated queries reuse the plan from the first time they were seen
+        with timer.stage("parse_query"):
+            plan = query_plans.get(data_set_id, version, query_args,
+                                   data_set['schema'], datasets_data.plan)
+        query = plan.query
+        pretty = options.get("pretty") == "true"
+
+        if "page_size" in query:
+            return paged_results(run_query(data_set_id, data_set, plan),
+                    query, options.get("format"), pretty)
 
-        results = datasets_data.query(data_set_id, query)
+        # Raw queries can be arbitrarily large so are encoded as they are
+        # read from storage
+        if not is_group_query(query):
+            return stream_results(run_query(data_set_id, data_set, plan),
+                    options.get("format"), pretty)
 
-        results = map(create_result_builder(query), results)
+        cache_key = (version, pretty, normalise_query(query))
+        body = query_cache.get(data_set_id, cache_key)
+        if body is None:
+            # A write during the query leaves its results out of the cache
+            generation = query_cache.generation(data_set_id)
+            with timer.stage("results"):
+                results = fill_gaps(
+                    list(iter_rows(run_query(data_set_id, data_set, plan))),
+                    query)
+            with timer.stage("encode"):
+                body = encode(results, pretty)
+            query_cache.set(data_set_id, cache_key, body, cache_ttl(data_set),
+                            generation)
 
-        return jsonify(results)
+        return app.response_class(body, mimetype='application/json')
+    except (ValidationError, InvalidQueryArgs) as e:
+        return jsonify({"status": "error", "message": error_message(e)}), 400
     except NotFound:
         return jsonify({"error": "Not found"}), 404
 
 
-# Helper functions
-class JsonEncoder(json.JSONEncoder):
+def run_query(data_set_id, data_set, plan):
+    """Run a query plan, building results a batch at a time"""
+    timer = g.timer
+    with timer.stage("query"):
+        batches = datasets_data.query(data_set_id, plan.query, data_set, plan)
+
+    return timer.wrap("results", imap(create_result_builder(plan.query),
+                                      timer.wrap("query", batches)))
+
+
+def queue_records(data_set_id, data_set, records):
+    """Queue records to be written, responding with a receipt"""
+    try:
+        receipt = ingest_queue.submit(data_set_id, data_set, records,
+                                      timeout=INGEST_TIMEOUT)
+    except QueueFull as e:
+        response = jsonify({"status": "error", "message": str(e)})
+        response.headers["Retry-After"] = str(INGEST_TIMEOUT)
+        return response, 503
 
-    def default(self, obj):
-        if isinstance(obj, ObjectId):
-            return str(obj)
-        if isinstance(obj, datetime.datetime):
-            return obj.isoformat()
-        return json.JSONEncoder.default(self, obj)
+    count_records(data_set_id, queued=receipt.count)
+    response = jsonify(receipt.as_dict())
+    response.headers["Location"] = "/ingest-receipts/{}".format(receipt.id)
+    return response, 202
+
+
+# Helper functions
+def count_records(data_set_id, **outcomes):
+    for outcome, count in outcomes.items():
+        if count:
+            metrics.increment("backdrop_records_total",
+                              {"data_set": data_set_id, "outcome": outcome},
+                              count)
 
 
 def jsonify(data):
-    return app.response_class(json.dumps(data, indent=2, cls=JsonEncoder),
-            mimetype='application/json')
+    """Encode a response, indented if the request asks for pretty output"""
+    return app.response_class(
+        encode(data, request.args.get("pretty") == "true"),
+        mimetype='application/json')
+
+
+def stream_results(batches, format, pretty):
+    """Return a chunked response encoding results as they are read"""
+    # Encoding is timed a batch at a time
+    encoded = chain.from_iterable(g.timer.wrap("encode", (
+        list(encode_batches([batch], pretty and format != "ndjson"))
+        for batch in batches)))
+    if format == "ndjson":
+        body = ndjson_lines(encoded)
+        mimetype = NDJSON_MIMETYPE
+    else:
+        body = json_array(encoded, pretty)
+        mimetype = 'application/json'
+
+    return app.response_class(chunked(body, STREAM_CHUNK_SIZE),
+            mimetype=mimetype)
+
+
+def paged_results(batches, query, format, pretty):
+    """Return a page of raw results, linking to the next page if any
+
+    Storage reads one result more than a page to tell if there is a next
+    page. Fields that were only read for the next page's token are
+    dropped.
+    """
+    page_size = query["page_size"]
+    results = list(islice(iter_rows(batches), page_size + 1))
+    page = results[:page_size]
+    token = page_token(page[-1], query) if len(results) > page_size else None
+
+    if query.get("fields"):
+        page = [dict((field, result[field]) for field in query["fields"]
+                     if field in result)
+                for result in page]
+    response = stream_results([ResultBatch.from_rows(page)], format, pretty)
+
+    if token is not None:
+        args = request.args.copy()
+        args["page_token"] = token
+        response.headers["Link"] = '<{}?{}>; rel="next"'.format(
+            request.base_url, url_encode(args))
+    return response
+
+
+def json_array(encoded, pretty=False):
+    """Join encoded results into a JSON array, one item at a time
+
+    >>> "".join(json_array(iter(['{"a":1}', '{"a":2}'])))
+    '[{"a":1},{"a":2}]'
+    >>> "".join(json_array(iter([])))
+    '[]'
+    """
+    separator = ",\n" if pretty else ","
+    yield "[\n" if pretty else "["
+    for index, result in enumerate(encoded):
+        if index:
+            yield separator
+        yield result
+    yield "\n]" if pretty else "]"
+
+
+def ndjson_lines(encoded):
+    """Join encoded results as newline delimited JSON
+
+    >>> list(ndjson_lines(iter(['{"a":1}'])))
+    ['{"a":1}\\n']
+    """
+    for result in encoded:
+        yield result + "\n"
+
+
+def chunked(strings, size):
+    """Join small strings into chunks of at least size characters
+
+    >>> list(chunked(["a", "b", "c"], 2))
+    ['ab', 'c']
+    """
+    chunk, length = [], 0
+    for string in strings:
+        chunk.append(string)
+        length += len(string)
+        if length >= size:
+            yield "".join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield "".join(chunk)
+
+
+def cache_ttl(data_set):
+    """The TTL a data set's metadata asks for its cached queries, if any
+
+    >>> cache_ttl({"cache": {"ttl": 10}})
+    10
+    >>> cache_ttl({})
+    """
+    return data_set.get("cache", {}).get("ttl")
+
+
+def is_async_ingest(data_set):
+    """
+    >>> is_async_ingest({"ingest": {"async": True}})
+    True
+    >>> is_async_ingest({})
+    False
+    """
+    return bool(data_set.get("ingest", {}).get("async"))
 
 
 def listify(data):
@@ -0,0 +1,283 @@
+"""Benchmark ingest and queries against synthetic records for a data set
+
+Records are generated from the data set's schema, parsed, saved and then
+queried, at each number of records given. Results are written as JSON so
+runs on different commits can be compared.
+
+    python benchmark.py foobar --records 10000 1000000 > before.json
+    python benchmark.py foobar --records 10000 1000000 --compare before.json
+
+Storage is a local mongod, where the benchmark database is dropped before
+each number of records, or with --storage local the embedded engine in a
+temporary directory.
+"""
+import argparse
+import json
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from timeit import default_timer
+
+from pymongo import MongoClient
+from werkzeug.datastructures import MultiDict
+
+from backdrop.data import create_record_parser, add_meta_fields
+from backdrop.models import FilesystemDataSets, thaw
+from backdrop.query import parse_query
+from backdrop.results import create_result_builder
+from backdrop.serialise import encode_batches
+from backdrop.storage.local import LocalData
+from backdrop.storage.mongo import MongoData
+
+
+# Records are parsed and saved this many at a time
+CHUNK_SIZE = 10000
+
+# Values string fields are picked from, so group_by has a few groups
+STRING_VALUES = 20
+
+START = datetime(2012, 1, 1)
+SPAN = timedelta(days=365)
+
+
+def record_generator(schema, seed=0):
+    """Return a function generating random records that match a schema
+
+    Optional fields are left out of one record in five.
+
+    >>> generate = record_generator({"properties": {
+    ...     "_timestamp": {"type": "string", "format": "date-time"},
+    ...     "count": {"type": "integer", "minimum": 0}},
+    ...     "required": ["_timestamp", "count"]})
+    >>> sorted(generate())
+    ['_timestamp', 'count']
+    """
+    rand = random.Random(seed)
+    required = set(schema.get("required", []))
+    fields = [(name, value_generator(name, spec, rand))
+              for name, spec in sorted(schema.get("properties", {}).items())]
+
+    def generate():
+        return dict((name, value()) for name, value in fields
+                    if name in required or rand.random() < 0.8)
+    return generate
+
+
+def value_generator(name, spec, rand):
+    if spec.get("format") == "date-time":
+        seconds = int(SPAN.total_seconds())
+        return lambda: (START + timedelta(seconds=rand.randrange(seconds))) \
+            .strftime("%Y-%m-%dT%H:%M:%S+00:00")
+    if spec.get("type") == "integer":
+        low = spec.get("minimum", 0)
+        return lambda: rand.randint(low, low + 10000)
+    if spec.get("type") == "number":
+        return lambda: rand.random() * 1000
+    if spec.get("type") == "boolean":
+        return lambda: rand.random() < 0.5
+    values = ["/{}/{}".format(name, index) for index in range(STRING_VALUES)]
+    return lambda: rand.choice(values)
+
+
+def benchmark_queries(schema):
+    """The queries to time, as query strings, for fields the schema has
+
+    >>> benchmark_queries({"properties": {
+    ...     "_timestamp": {"type": "string"}, "foo": {"type": "string"},
+    ...     "bar": {"type": "integer"}}})[:3]
+    [('raw', 'limit=1000'), ('group_by', 'group_by=foo'), ('period', 'period=week')]
+    """
+    properties = schema.get("properties", {})
+    strings = sorted(name for name, spec in properties.items()
+                     if spec.get("type") == "string" and name[0] != "_")
+    numbers = sorted(name for name, spec in properties.items()
+                     if spec.get("type") in ("integer", "number"))
+
+    queries = [("raw", "limit=1000")]
+    if strings:
+        queries.append(("group_by", "group_by={}".format(strings[0])))
+    if "_timestamp" in properties:
+        queries.append(("period", "period=week"))
+    if numbers and "_timestamp" in properties:
+        queries.append(("collect", "period=month&collect={0}:sum"
+                                   "&collect={0}:mean".format(numbers[0])))
+    if numbers and strings:
+        queries.append(("group_by_collect", "group_by={}&collect={}:sum"
+                        .format(strings[0], numbers[0])))
+    return queries
+
+
+def run_ingest(storage, data_set_id, data_set, count, seed):
+    """Parse and save count records, timing each step separately"""
+    schema = data_set["schema"]
+    parser = create_record_parser(schema)
+    generate = record_generator(schema, seed)
+    timings = {"parse": 0.0, "add_meta_fields": 0.0, "save": 0.0}
+
+    remaining = count
+    while remaining:
+        raw = [generate() for _ in xrange(min(CHUNK_SIZE, remaining))]
+        remaining -= len(raw)
+
+        started = default_timer()
+        records = [parser(record) for record in raw]
+        timings["parse"] += default_timer() - started
+
+        # Meta fields again, on their own, as parsing already added them
+        started = default_timer()
+        for record in records:
+            add_meta_fields(record)
+        timings["add_meta_fields"] += default_timer() - started
+
+        started = default_timer()
+        storage.save(data_set_id, records, data_set)
+        timings["save"] += default_timer() - started
+
+    return [{"name": name, "records": count, "seconds": seconds,
+             "records_per_second": count / seconds if seconds else None}
+            for name, seconds in sorted(timings.items())]
+
+
+def run_query(storage, data_set_id, data_set, name, query_string, count,
+              repeat):
+    """Time a query from storage through to encoded JSON"""
+    query = parse_query(
+        MultiDict(pair.split("=", 1) for pair in query_string.split("&")),
+        data_set["schema"])
+    plan = storage.plan(query)
+    build = create_result_builder(query)
+
+    timings, results = [], 0
+    for _ in range(repeat):
+        started = default_timer()
+        batches = storage.query(data_set_id, query, data_set, plan)
+        results = sum(1 for _ in encode_batches(build(batch)
+                                                for batch in batches))
+        timings.append(default_timer() - started)
+
+    timings.sort()
+    return {"name": "query:{}".format(name), "query": query_string,
+            "records": count, "results": results,
+            "min_ms": timings[0] * 1000,
+            "median_ms": timings[len(timings) // 2] * 1000,
+            "max_ms": timings[-1] * 1000}
+
+
+def compare(baseline, results, tolerance):
+    """Compare results with a baseline, returning lines and regressions
+
+    Throughput is compared by records per second and queries by their
+    median latency.
+
+    >>> lines, slower = compare(
+    ...     [{"name": "save", "records": 10, "records_per_second": 100.0}],
+    ...     [{"name": "save", "records": 10, "records_per_second": 50.0}],
+    ...     0.2)
+    >>> lines, slower
+    (['save 10 records: 100 -> 50 records/s, 2.00x slower'], 1)
+    """
+    previous = dict(((result["name"], result["records"]), result)
+                    for result in baseline)
+    lines, slower = [], 0
+    for result in results:
+        before = previous.get((result["name"], result["records"]))
+        if before is None:
+            continue
+        if "records_per_second" in result:
+            old, new = before["records_per_second"], \
+                result["records_per_second"]
+            unit, ratio = "records/s", old / new if new else None
+        else:
+            old, new = before["median_ms"], result["median_ms"]
+            unit, ratio = "ms", new / old if old else None
+        if not ratio:
+            continue
+        change = "{:.2f}x {}".format(
+            ratio if ratio >= 1 else 1 / ratio,
+            "slower" if ratio >= 1 else "faster")
+        lines.append("{} {} records: {:.4g} -> {:.4g} {}, {}".format(
+            result["name"], result["records"], old, new, unit, change))
+        if ratio > 1 + tolerance:
+            slower += 1
+    return lines, slower
+
+
+def create_storage(args, path):
+    if args.storage == "local":
+        return LocalData(path)
+    MongoClient(args.host).drop_database(args.database)
+    return MongoData(args.host, args.database)
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("data_set_id")
+    parser.add_argument("--records", type=int, nargs="+", default=[10000],
+                        help="numbers of records to benchmark with")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="times to run each query")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--storage", choices=["mongo", "local"],
+                        default="mongo")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--database", default="backdrop_benchmark")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="compare with the JSON output of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="fraction slower than the baseline allowed")
+    args = parser.parse_args()
+
+    # The data set's storage options are kept but it is never capped
+    data_set = thaw(FilesystemDataSets().get(args.data_set_id))
+    data_set_id = "benchmark_{}".format(args.data_set_id)
+
+    results = []
+    for count in args.records:
+        path = tempfile.mkdtemp(prefix="backdrop-benchmark-")
+        try:
+            storage = create_storage(args, path)
+            storage.create(data_set_id, False, 0, data_set["schema"])
+
+            results.extend(run_ingest(storage, data_set_id, data_set, count,
+                                      args.seed))
+            for name, query_string in benchmark_queries(data_set["schema"]):
+                results.append(run_query(storage, data_set_id, data_set,
+                                         name, query_string, count,
+                                         args.repeat))
+        finally:
+            shutil.rmtree(path)
+        sys.stderr.write("{} records done\n".format(count))
+
+    json.dump({
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "storage": args.storage,
+        "data_set": args.data_set_id,
+        "seed": args.seed,
+        "results": results,
+    }, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            lines, slower = compare(json.load(baseline)["results"], results,
+                                    args.tolerance)
+        for line in lines:
+            sys.stderr.write(line + "\n")
+        if slower:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
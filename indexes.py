@@ -0,0 +1,50 @@
+"""List the indexes a data set needs for an observed query workload
+
+Queries are read from stdin, one query string or request path per line, eg.
+as pulled from access logs. Indexes the collection does not have yet are
+printed one per line as JSON, and created if --create is given.
+
+    python indexes.py foobar < queries.txt
+"""
+import argparse
+import json
+import sys
+
+from werkzeug.urls import url_decode
+
+from backdrop.models import FilesystemDataSets
+from backdrop.query import parse_query, split_response_args
+from backdrop.storage.mongo import MongoData
+
+
+def read_queries(lines, schema):
+    for line in lines:
+        line = line.strip()
+        if line:
+            _, query_args = split_response_args(
+                url_decode(line.split("?", 1)[-1]))
+            yield parse_query(query_args, schema)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("data_set_id")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--database", default="backdroop")
+    parser.add_argument("--create", action="store_true",
+                        help="create the missing indexes")
+    args = parser.parse_args()
+
+    schema = FilesystemDataSets().get(args.data_set_id).get("schema", {})
+    queries = list(read_queries(sys.stdin, schema))
+
+    storage = MongoData(args.host, args.database)
+    missing = storage.missing_indexes(args.data_set_id, schema, queries)
+    for index in missing:
+        print json.dumps(index)
+
+    if args.create:
+        storage.create_indexes(args.data_set_id, missing)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,62 @@
-from backdrop.webapp import app
+import argparse
+
+from backdrop.webapp import app, record_pool, datasets, datasets_data, \
+    profiler, use_local_data, MONGO_HOST
+from backdrop.storage.connections import ConnectionConfig, READ_PREFERENCES
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--parser-processes", type=int, default=0,
+                        help="parse large uploads on this many processes")
+    parser.add_argument("--data-dir",
+                        help="keep data sets in local files here instead "
+                             "of Mongo, for a single node")
+    parser.add_argument("--mongo-host", action="append",
+                        help="a Mongo host or replica set member, repeatable")
+    parser.add_argument("--replica-set",
+                        help="the name of the Mongo replica set")
+    parser.add_argument("--read-preference", default="primary",
+                        choices=READ_PREFERENCES,
+                        help="where queries are read from")
+    parser.add_argument("--pool-size", type=int,
+                        help="maximum connections to each Mongo server")
+    parser.add_argument("--socket-timeout", type=float,
+                        help="seconds to wait for a Mongo response")
+    parser.add_argument("--wait-queue-timeout", type=float,
+                        help="seconds to wait for a pooled connection")
+    parser.add_argument("--profile-dir",
+                        help="write profiles of slow requests here")
+    parser.add_argument("--profile-rate", type=float, default=0.01,
+                        help="fraction of requests to profile")
+    parser.add_argument("--profile-slow", type=float, default=1.0,
+                        help="keep profiles of requests slower than this")
+    parser.add_argument("--rebuild-rollups", metavar="DATA_SET_ID",
+                        help="build a data set's rollups from its records "
+                             "and exit")
+    args = parser.parse_args()
+    if args.data_dir and args.rebuild_rollups:
+        parser.error("local data sets do not keep rollups")
+
+    record_pool.processes = args.parser_processes
+    if args.profile_dir:
+        profiler.directory = args.profile_dir
+        profiler.rate = args.profile_rate
+        profiler.slow = args.profile_slow
+    if args.data_dir:
+        use_local_data(args.data_dir)
+    else:
+        datasets_data.connect(args.mongo_host or MONGO_HOST, ConnectionConfig(
+            pool_size=args.pool_size,
+            socket_timeout=args.socket_timeout,
+            wait_queue_timeout=args.wait_queue_timeout,
+            replica_set=args.replica_set,
+            read_preference=args.read_preference))
+    if args.rebuild_rollups:
+        count = datasets_data.rebuild_rollups(
+            args.rebuild_rollups, datasets.get(args.rebuild_rollups))
+        print "Rolled up {} records".format(count)
+        return
     app.debug = True
     app.run(host='0.0.0.0', port=8080)
 